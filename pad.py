@@ -1,8 +1,126 @@
 import re
+import ast
 import os
 import sys
+import hashlib
+import bisect
+import itertools
+import argparse
+import glob
+import concurrent.futures
+import marshal
+import tempfile
+import time
+import zlib
+import cProfile
+import pstats
+import operator
+import asyncio
+import inspect
+import json
 from pathlib import Path
 
+class Stats():
+    """Wall time and allocated memory blocks of each phase, tokens by type and branch nesting paths.
+    Phases: file, load, scan, keywords (part of scan), parse, rules (part of parse) and transpile. keywords and rules
+    are made of many short calls: their time is added up and ends with the scan or the parse, without allocated blocks."""
+    hooks = [] # callables (stats, phase, seconds, allocated blocks) called when a phase ends, in the process doing the work
+
+    def __init__(self, name = None):
+        self.name = name
+        self.phases = {} # phase => [ calls, seconds, allocated blocks ]
+        self.token_types = {}
+        self.branch_paths = {} # "if > for each" => number of branches created with this nesting
+        self.files = [] # (seconds, name) of the merged stats
+        self.active = set()
+        self.sums = {} # phase => seconds added up since its last stop_sum
+
+    def start(self):
+        return time.perf_counter(), sys.getallocatedblocks()
+
+    def stop(self, phase, started):
+        seconds = time.perf_counter() - started[0]
+        allocations = sys.getallocatedblocks() - started[1]
+        self.add(phase, seconds, allocations)
+
+    def stop_sum(self, phase):
+        if phase in self.sums:
+            self.add(phase, self.sums.pop(phase), 0)
+
+    def add(self, phase, seconds, allocations):
+        entry = self.phases.setdefault(phase, [ 0, 0.0, 0 ])
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] += allocations
+        for hook in Stats.hooks:
+            hook(self, phase, seconds, allocations)
+
+    def timed(self, phase, function):
+        def timed_function(*args, **kwargs):
+            if phase in self.active: # recursive call, already timed
+                return function(*args, **kwargs)
+            self.active.add(phase)
+            started = self.start()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.stop(phase, started)
+                self.active.discard(phase)
+        return timed_function
+
+    def summed(self, phase, function):
+        """function with its time added up, until stop_sum(phase) records it as a single call."""
+        def summed_function(*args, **kwargs):
+            if phase in self.active: # recursive call, already timed
+                return function(*args, **kwargs)
+            self.active.add(phase)
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.sums[phase] = self.sums.get(phase, 0.0) + time.perf_counter() - started
+                self.active.discard(phase)
+        return summed_function
+
+    def count_tokens(self, tokens_rows):
+        for tokens_row in tokens_rows:
+            for token in tokens_row:
+                self.token_types[token.type] = self.token_types.get(token.type, 0) + 1
+
+    def count_branch(self, open_branches):
+        path = " > ".join(branch.token.name for branch in open_branches)
+        self.branch_paths[path] = self.branch_paths.get(path, 0) + 1
+
+    def merge(self, other):
+        for phase, (calls, seconds, allocations) in other.phases.items():
+            entry = self.phases.setdefault(phase, [ 0, 0.0, 0 ])
+            entry[0] += calls
+            entry[1] += seconds
+            entry[2] += allocations
+        for names, other_names in [ (self.token_types, other.token_types), (self.branch_paths, other.branch_paths) ]:
+            for name, count in other_names.items():
+                names[name] = names.get(name, 0) + count
+        self.files.extend(other.files)
+        if "file" in other.phases:
+            self.files.append((other.phases["file"][1], other.name))
+
+    def print(self, top = 10, file = sys.stdout):
+        type_names = { value: name for name, value in vars(Token).items() if isinstance(value, str) and len(value) == 1 }
+        print(f"{'phase':10} {'calls':>8} {'seconds':>10} {'blocks':>10}", file = file)
+        for phase, (calls, seconds, allocations) in self.phases.items():
+            print(f"{phase:10} {calls:8} {seconds:10.4f} {allocations:10}", file = file)
+        print("\ntokens", file = file)
+        for type, count in sorted(self.token_types.items(), key = lambda item: -item[1]):
+            print(f"    {type_names.get(type, type):14} {count:10}", file = file)
+        if len(self.branch_paths) > 0:
+            print("\nhottest branch paths", file = file)
+            for path, count in sorted(self.branch_paths.items(), key = lambda item: -item[1])[:top]:
+                print(f"    {count:8}  {path}", file = file)
+        if len(self.files) > 0:
+            print("\nslowest files", file = file)
+            for seconds, name in sorted(self.files, key = lambda item: -item[0])[:top]:
+                print(f"    {seconds:8.4f}  {name}", file = file)
+
 class Token():
     KEYWORD = 'K'
     IDENTIFIER = 'I'
@@ -12,8 +130,10 @@ class Token():
     PRINTMODE = 'P'
     PRINTINCFILE = 'F'
 
+    __slots__ = ("name", "type", "value", "line", "column")
+
     def __init__(self, name, type, value, line, column):
-        self.name = name.strip().lower()
+        self.name = sys.intern(name.strip().lower())
         self.type = type
         self.value = value
         self.line = line + 1
@@ -24,81 +144,193 @@ class Token():
             return f"[{self.type}|{self.name}={self.value}] "
         return f"[{self.type}|{self.name}] "
     
+def to_trie(phrases):
+    trie = {}
+    for phrase in phrases:
+        node = trie
+        for word in phrase.split(" "):
+            node = node.setdefault(word, {})
+        node[""] = sys.intern(phrase) # words are never empty, "" marks the end of a phrase
+    return trie
+
 class Lexer():
     reserved = [ "if","then","else","elseif","end","end if","dim","function","end function","do while","loop","for","next","exit for",
-                 "exit do","exit function", "mod","and","or","not","set","on error resume next","call","byref","byval","new"]
+                 "exit do","exit function", "mod","and","or","not","set","on error resume next","call","byref","byval","new",
+                 "sub","end sub","exit sub","for each","in"]
     reserved_print = [ "#include file", "#include virtual" ]
-    double_operators = [ "==", "!=", ">=", "<=" ]
+    keywords = to_trie(reserved)
+    double_operators = [ "==", "!=", ">=", "<=", "<>" ]
     start_identifier = re.compile('[a-zA-Z_]')
     in_identifier = re.compile('[a-zA-Z0-9_]')
-    start_in_operator = re.compile('[\-+/*\(\)=><\.,]') 
+    start_in_operator = re.compile(r'[\-+/*\(\)=><\.,&^\\:]')
     start_string = re.compile('\"')
     start_number = re.compile('[0-9]')
-    in_number = re.compile('[0-9\.]')
-    print_inc = re.compile(' ?#include +(\w+)[^"]*"([^"]+) ?"')
+    in_number = re.compile(r'[0-9\.]')
+    print_inc = re.compile(r' ?#include +(\w+)[^"]*"([^"]+) ?"')
 
-    def __init__(self):
+    def __init__(self, incremental = False, stats = None):
         self.source_tokens = []
         self.errors = []
+        self.error_items = []
         self.in_asp = False
+        self.incremental = incremental
+        self.source = []
+        self.row_lines = [] # first line of each row
+        self.row_states = [] # in_asp at the start of each row
+        self.row_errors = [] # number of errors before each row
+        self.stats = stats
+        if stats:
+            self.lex = stats.timed("scan", self.lex)
+            self.add_word = stats.summed("keywords", self.add_word)
+            self.end_keyword = stats.summed("keywords", self.end_keyword)
 
     def lex(self, source):
-        self.l = 0 # line number
+        if self.incremental:
+            source = list(source)
+            self.source.extend(source)
+        first_row = len(self.source_tokens)
+        for tokens_row in self.iter_rows(source):
+            self.source_tokens.append(tokens_row)
+            if self.incremental:
+                self.add_row_state()
+        if self.stats:
+            self.stats.count_tokens(self.source_tokens[first_row:])
+            self.stats.stop_sum("keywords")
+
+    def update(self, start_line, end_line, new_lines):
+        """Replace the source lines start_line to end_line (excluded, 0-based) by new_lines.
+        Only the rows from the edit up to the point where the lexing state matches the previous
+        lexing again are lexed. Returns (first row, number of rows removed, number of rows added)."""
+        new_lines = list(new_lines)
+        delta = len(new_lines) - (end_line - start_line)
+        edit_end = start_line + len(new_lines)
+        self.source[start_line:end_line] = new_lines
+
+        first_row = max(bisect.bisect_right(self.row_lines, start_line) - 1, 0)
+        first_line = self.row_lines[first_row] if first_row < len(self.row_lines) else 0
+        end_in_asp = self.in_asp
+        old_errors = self.error_items
+        self.error_items = old_errors[:self.row_errors[first_row]] if first_row < len(self.row_errors) else []
+        self.in_asp = self.row_states[first_row] if first_row < len(self.row_states) else False
+
+        rows, row_lines, row_states, row_errors = [], [], [], []
+        last_row = len(self.source_tokens)
+        for tokens_row in self.iter_rows(itertools.islice(self.source, first_line, None), first_line):
+            rows.append(tokens_row)
+            row_lines.append(self.row_l)
+            row_states.append(self.row_in_asp)
+            row_errors.append(self.row_error_count)
+            if self.l + 1 >= edit_end:
+                old_row = bisect.bisect_left(self.row_lines, self.l + 1 - delta)
+                if old_row < len(self.row_lines) and self.row_lines[old_row] == self.l + 1 - delta and self.row_states[old_row] == self.in_asp:
+                    last_row = old_row
+                    self.in_asp = end_in_asp
+                    break
+
+        old_tail = old_errors[self.row_errors[last_row]:] if last_row < len(self.row_errors) else []
+        errors_shift = len(self.error_items) + len(old_tail) - len(old_errors)
+        for errormessage, line, column in old_tail:
+            self.error_items.append((errormessage, line + delta, column))
+        if delta != 0:
+            for tokens_row in self.source_tokens[last_row:]:
+                for token in tokens_row:
+                    token.line += delta
+
+        self.source_tokens[first_row:last_row] = rows
+        self.row_lines[first_row:last_row] = row_lines
+        self.row_states[first_row:last_row] = row_states
+        self.row_errors[first_row:last_row] = row_errors
+        for r in range(first_row + len(rows), len(self.row_lines)):
+            self.row_lines[r] += delta
+            self.row_errors[r] += errors_shift
+        self.errors = [ self.format_error(*item) for item in self.error_items ]
+        if self.stats:
+            self.stats.stop_sum("keywords")
+        return first_row, last_row - first_row, len(rows)
+
+    def add_row_state(self):
+        self.row_lines.append(self.row_l)
+        self.row_states.append(self.row_in_asp)
+        self.row_errors.append(self.row_error_count)
+
+    def iter_tokens(self, lines):
+        for tokens_row in self.iter_rows(lines):
+            yield from tokens_row
+
+    def iter_rows(self, lines, first_line = 0):
+        self.l = first_line # line number
         self.i = 0 # position in that line
         self.start_l = self.l
         self.start_i = self.i
-        self.source = source
+        self.line = ""
+        self.print_acc = None # text of a print block still open at the end of the line
+        self.tokens = []
+        self.keyword_node = None # keywords trie node reached by the words ending the row
 
-        while self.l < len(source):
-            line = source[self.l]
-            self.tokens = []
+        for self.l, self.line in enumerate(lines, first_line):
+            if self.print_acc is None:
+                self.row_l = self.l
+                self.row_in_asp = self.in_asp
+                self.row_error_count = len(self.error_items)
             self.i = 0
-            while self.i < len(line):
-                char = self.get_char()
-                char2 = self.get_char(1)
-                char3 = self.get_char(2)
-                self.start_l = self.l
-                self.start_i = self.i
-
+            while self.i < len(self.line):
+                if self.print_acc is None:
+                    self.start_l = self.l
+                    self.start_i = self.i
                 if self.in_asp:
-                    if char == '%' and char2 == '>':
-                        self.in_asp = False
-                        self.i += 2
-                    elif char == '\'' or (char == 'R' and char2 == 'E' and char3 == 'M'):
-                        break
-                    elif Lexer.start_identifier.match(char):
-                        self.parse_identifier(source)
-                    elif Lexer.start_in_operator.match(char):
-                        self.parse_operator(source)
-                    elif Lexer.start_string.match(char):
-                        self.parse_string(source)
-                    elif Lexer.start_number.match(char):
-                        self.parse_number(source)
-                    else:
-                        self.i += 1
+                    self.lex_asp()
                 else:
-                    self.parse_print(source)
+                    self.parse_print()
+
+            if self.print_acc is None:
+                self.end_keyword()
+                yield self.tokens
+                self.tokens = []
+
+        if self.print_acc is not None:
+            self.parse_print_add_token("".join(self.print_acc))
+            self.print_acc = None
+            self.end_keyword()
+            yield self.tokens
+            self.tokens = []
+
+    def lex_asp(self):
+        char = self.get_char()
+        char2 = self.get_char(1)
+        char3 = self.get_char(2)
 
-            self.source_tokens.append(self.tokens)
-            self.l += 1
-        self.set_type()
+        if char == '%' and char2 == '>':
+            self.in_asp = False
+            self.i += 2
+        elif char == '\'' or (char == 'R' and char2 == 'E' and char3 == 'M'):
+            self.i = len(self.line)
+        elif Lexer.start_identifier.match(char):
+            self.parse_identifier()
+        elif Lexer.start_in_operator.match(char):
+            self.parse_operator()
+        elif Lexer.start_string.match(char):
+            self.parse_string()
+        elif Lexer.start_number.match(char):
+            self.parse_number()
+        else:
+            self.i += 1
     
     def get_char(self, add = 0):
-        return self.source[self.l][self.i + add] if self.l < len(self.source) and self.i + add < len(self.source[self.l]) else '\n'
+        return self.line[self.i + add] if self.i + add < len(self.line) else '\n'
     
-    def parse_identifier(self, source):
+    def parse_identifier(self):
         acc = ""
-        while self.i < len(source[self.l]):
+        while self.i < len(self.line):
             char = self.get_char()
             if not Lexer.in_identifier.match(char):
                 break
             acc += char
             self.i += 1
-        self.tokens.append(Token(acc, Token.IDENTIFIER, None, self.start_l, self.start_i))
+        self.add_word(Token(acc, Token.IDENTIFIER, None, self.start_l, self.start_i))
     
-    def parse_operator(self, source):
+    def parse_operator(self):
         acc = ""
-        while self.i < len(source[self.l]):
+        while self.i < len(self.line):
             char = self.get_char()
             if not Lexer.start_in_operator.match(char):
                 break
@@ -110,10 +342,10 @@ class Lexer():
             for i, op in enumerate(acc):
                 self.tokens.append(Token(op, Token.OPERATOR, None, self.start_l, self.start_i + i))
 
-    def parse_string(self, source):
+    def parse_string(self):
         acc = ""
         self.i += 1
-        while self.i < len(source[self.l]):
+        while self.i < len(self.line):
             char = self.get_char()
             char2 = self.get_char(1)
 
@@ -130,9 +362,9 @@ class Lexer():
             self.i += 1
         self.set_error(f"Missing string closing: {acc}", self.l, self.i)
 
-    def parse_number(self, source):
+    def parse_number(self):
         acc = ""
-        while self.i < len(source[self.l]):
+        while self.i < len(self.line):
             char = self.get_char()
             if not Lexer.in_number.match(char):
                 break
@@ -140,35 +372,44 @@ class Lexer():
             self.i += 1
         self.tokens.append(Token(acc, Token.NUMBER, None, self.start_l, self.start_i))
     
-    def parse_print(self, source):
-        acc = ""
-        while self.l < len(source):
-            while self.i < len(source[self.l]):
-                char = self.get_char()
-
-                if char == '<' and self.get_char(1) == '%':
-                    return self.parse_print_add_token(acc)
-                elif char == '<' and self.get_char(1) == '!' and self.get_char(2) == '-' and self.get_char(3) == '-':
-                    self.parse_print_add_token(acc, False)
-                    acc = ""
-                    self.parse_print_command(source)
-                else:
-                    acc += char
-                    self.i += 1
-            self.l += 1
-            self.i = 0
-        self.parse_print_add_token(acc)
+    def parse_print(self):
+        if self.print_acc is None:
+            self.print_acc = []
+        start = self.i
+        while self.i < len(self.line):
+            char = self.get_char()
+
+            if char == '<' and self.get_char(1) == '%':
+                self.print_acc.append(self.line[start:self.i])
+                return self.parse_print_add_token(self.pop_print_acc())
+            elif char == '<' and self.get_char(1) == '!' and self.get_char(2) == '-' and self.get_char(3) == '-':
+                self.print_acc.append(self.line[start:self.i])
+                self.parse_print_add_token(self.pop_print_acc(), False)
+                self.print_acc = []
+                self.parse_print_command()
+                start = self.i
+            else:
+                self.i += 1
+        self.print_acc.append(self.line[start:self.i])
+
+    def pop_print_acc(self):
+        acc = "".join(self.print_acc)
+        self.print_acc = None
+        return acc
     
     def parse_print_add_token(self, acc, in_asp = True):
-        if len(acc) > 0:
+        # empty text kept between two ASP blocks (%><%), it separates their statements
+        if len(acc) > 0 or (in_asp and self.start_i >= 2 and self.line.startswith("%>", self.start_i - 2)):
             self.tokens.append(Token("#", Token.PRINTMODE, acc, self.start_l, self.start_i))
         self.i += 2
         self.in_asp = in_asp
 
-    def parse_print_command(self, source):
+    def parse_print_command(self):
         acc = ""
+        self.start_l = self.l
+        self.start_i = self.i - 2
         self.i += 2
-        while self.i < len(source[self.l]):
+        while self.i < len(self.line):
             char = self.get_char()
             if char == '-' and self.get_char(1) == '-' and self.get_char(2) == '>':
                 match = Lexer.print_inc.match(acc)
@@ -177,39 +418,78 @@ class Lexer():
                 else:
                     self.set_error(f"Invalid command content: {acc}", self.l, self.i)
                 self.i += 3
+                self.start_i = self.i
                 return
             elif char != "\n":
                 acc += char
             self.i += 1
         self.set_error(f"Invalid command closing: {acc}", self.l, self.i)
+        self.start_i = self.i
     
-    def set_type(self):
-        for l in range(0, len(self.source_tokens)):
-            for i in range(0, len(self.source_tokens[l])):
-                token = self.source_tokens[l][i]
-                if i + 1 < len(self.source_tokens[l]):
-                    token2 = self.source_tokens[l][i + 1]
-                    merged = token.name + " " + token2.name
-                    if merged in Lexer.reserved:
-                        token.name = merged
-                        token.type = Token.KEYWORD
-                        token2.name = ""
-                        continue
-                if token.name in Lexer.reserved:
-                    token.type = Token.KEYWORD
-            self.source_tokens[l] = [t for t in self.source_tokens[l] if t.name != ""]
+    def add_word(self, token):
+        tokens = self.tokens
+        if self.keyword_node is not None and self.keyword_end == len(tokens):
+            node = self.keyword_node.get(token.name)
+            if node is not None:
+                tokens.append(token)
+                self.keyword_node = node
+                self.keyword_end += 1
+                if "" in node:
+                    self.keyword_best = self.keyword_end
+                return
+        self.end_keyword()
+        tokens.append(token)
+
+        node = Lexer.keywords.get(token.name)
+        if node is None:
+            return
+        if len(node) == 1 and "" in node:
+            token.type = Token.KEYWORD
+            return
+        self.keyword_node = node
+        self.keyword_start = len(tokens) - 1
+        self.keyword_end = len(tokens)
+        self.keyword_best = self.keyword_end if "" in node else self.keyword_start
+
+    def end_keyword(self):
+        if self.keyword_node is None:
+            return
+        self.keyword_node = None
+        tokens = self.tokens
+        start, best, end = self.keyword_start, self.keyword_best, self.keyword_end
+        if best > start:
+            node = Lexer.keywords
+            for token in tokens[start:best]:
+                node = node[token.name]
+            tokens[start].name = node[""]
+            tokens[start].type = Token.KEYWORD
+        else:
+            best = start + 1
+        # words after the longest keyword found are matched again, before the tokens that stopped the match
+        words = tokens[best:end]
+        others = tokens[end:]
+        del tokens[start + 1:]
+        for token in words:
+            self.add_word(token)
+        if len(others) > 0:
+            self.end_keyword()
+            tokens.extend(others)
 
     def set_error(self, errormessage, line, column):
+        self.error_items.append((errormessage, line, column))
+        self.errors.append(self.format_error(errormessage, line, column))
+
+    def format_error(self, errormessage, line, column):
         ln = ""
         if line >= 0:
             ln = f"Line {line + 1}"
             if column >= 0:
                 ln += f", column {column + 1}"
             ln += ": "
-        self.errors.append(ln + errormessage)
+        return ln + errormessage
 
     def print(self):
-        for line in lexer.source_tokens:
+        for line in self.source_tokens:
             for t in line:
                 print(t, end="")
             print("")
@@ -220,6 +500,264 @@ class Lexer():
         for err in self.errors:
             print(err, file=sys.stderr)
  
+class RegexLexer(Lexer):
+    asp_scanner = re.compile(r"""
+        (?P<end>%>)
+        |(?P<comment>'|REM)
+        |(?P<identifier>[a-zA-Z_][a-zA-Z0-9_]*)
+        |(?P<operator>[-+/*()=><.,&^\\:]+)
+        |(?P<string>"(?:[^"]|"")*"?)
+        |(?P<number>[0-9][0-9.]*)
+        |(?P<skip>[^a-zA-Z0-9_%'"\-+/*()=><.,&^\\:]+|.)
+        """, re.VERBOSE | re.DOTALL)
+    print_stop = re.compile('<%|<!--')
+
+    def lex_asp(self):
+        line = self.line
+        for match in RegexLexer.asp_scanner.finditer(line, self.i):
+            kind = match.lastgroup
+            self.i = match.end()
+            start = match.start()
+            if kind == "skip":
+                continue
+            elif kind == "identifier":
+                self.add_word(Token(match[0], Token.IDENTIFIER, None, self.l, start))
+            elif kind == "operator":
+                acc = match[0]
+                if len(acc) > 1 and acc in Lexer.double_operators:
+                    self.tokens.append(Token(acc, Token.OPERATOR, None, self.l, start))
+                else:
+                    for i, op in enumerate(acc):
+                        self.tokens.append(Token(op, Token.OPERATOR, None, self.l, start + i))
+            elif kind == "string":
+                body = match[0][1:]
+                acc = body.replace('""', '"').replace("\n", "")
+                if (len(body) - len(body.rstrip('"'))) % 2 == 1:
+                    self.tokens.append(Token("#", Token.STRING, acc[:-1], self.l, start))
+                else:
+                    self.set_error(f"Missing string closing: {acc}", self.l, self.i)
+            elif kind == "number":
+                self.tokens.append(Token(match[0], Token.NUMBER, None, self.l, start))
+            elif kind == "comment":
+                self.i = len(line)
+                return
+            else:
+                self.in_asp = False
+                return
+        self.i = len(line)
+
+    def parse_print(self):
+        if self.print_acc is None:
+            self.print_acc = []
+        line = self.line
+        while self.i < len(line):
+            match = RegexLexer.print_stop.search(line, self.i)
+            if not match:
+                break
+            self.print_acc.append(line[self.i:match.start()])
+            self.i = match.start()
+            if match[0] == '<%':
+                return self.parse_print_add_token(self.pop_print_acc())
+            self.parse_print_add_token(self.pop_print_acc(), False)
+            self.print_acc = []
+            self.parse_print_command()
+        self.print_acc.append(line[self.i:])
+        self.i = len(line)
+
+class IncludeResolver():
+    include_types = [ "file", "virtual" ]
+
+    def __init__(self, root = ".", lexer_class = Lexer, cache = None, disk_cache = None, stats = None):
+        self.stats = stats
+        self.root = root
+        self.lexer_class = lexer_class
+        self.cache = {} if cache is None else cache # included path => (mtime, size, digest, rows, errors)
+        self.disk_cache = disk_cache
+        self.errors = []
+        self.including = []
+        self.digests = [] # content digest of every file expanded, in order
+        self.paths = [] # path of every file expanded, same order as digests
+        self.includes = {} # path => paths it includes, found or not
+        self.row_paths = [] # path of the file of each row yielded
+
+    def iter_rows(self, file_name):
+        path = os.path.normpath(file_name)
+        self.including.append(path)
+        try:
+            for tokens_row in self.get_rows(path):
+                start = 0
+                for j, token in enumerate(tokens_row):
+                    if token.type == Token.PRINTINCFILE:
+                        if j > start:
+                            self.row_paths.append(path)
+                            yield tokens_row[start:j]
+                        start = j + 1
+                        yield from self.iter_include_rows(token, path)
+                if start == 0:
+                    self.row_paths.append(path)
+                    yield tokens_row
+                elif start < len(tokens_row):
+                    self.row_paths.append(path)
+                    yield tokens_row[start:]
+        finally:
+            self.including.pop()
+
+    def iter_include_rows(self, token, path):
+        if not token.name in IncludeResolver.include_types:
+            self.set_error(path, token, f"Invalid include type: {token.name}")
+            return
+        include_path = self.resolve(token, path)
+        self.includes.setdefault(path, []).append(include_path)
+        if include_path in self.including:
+            cycle = " -> ".join(self.including[self.including.index(include_path):] + [ include_path ])
+            self.set_error(path, token, f"Include cycle: {cycle}")
+            return
+        if not os.path.isfile(include_path):
+            self.set_error(path, token, f"Include file not found: {token.value}")
+            return
+        yield from self.iter_rows(include_path)
+
+    def resolve(self, token, path):
+        value = token.value.strip().replace("\\", "/")
+        if token.name == "virtual" and value.startswith("/"):
+            return os.path.normpath(os.path.join(self.root, value.lstrip("/")))
+        return os.path.normpath(os.path.join(os.path.dirname(path), value))
+
+    def get_rows(self, path):
+        stat = os.stat(path)
+        cached = self.cache.get(path)
+        if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return self.use_cached(path, cached)
+
+        started = self.stats.start() if self.stats else None
+        with open(path, 'r') as file:
+            source = file.readlines()
+        digest = hashlib.sha256("".join(source).encode()).hexdigest()
+        if self.stats:
+            self.stats.stop("load", started)
+        if cached and cached[2] == digest:
+            cached = (stat.st_mtime_ns, stat.st_size) + cached[2:]
+            self.cache[path] = cached
+            return self.use_cached(path, cached)
+
+        data = self.disk_cache.get("lex", digest) if self.disk_cache else None
+        if data:
+            rows, errors = DiskCache.load_rows(data[0]), data[1]
+        else:
+            lexer = self.lexer_class(stats = self.stats)
+            lexer.lex(source)
+            rows, errors = lexer.source_tokens, lexer.errors
+            if self.disk_cache:
+                self.disk_cache.set("lex", digest, (DiskCache.dump_rows(rows), errors))
+        cached = (stat.st_mtime_ns, stat.st_size, digest, rows, errors)
+        if len(self.including) > 1:
+            self.cache[path] = cached
+        return self.use_cached(path, cached)
+
+    def use_cached(self, path, cached):
+        self.digests.append(cached[2])
+        self.paths.append(path)
+        for err in cached[4]:
+            self.errors.append(f"{path}: {err}")
+        return cached[3]
+
+    def set_error(self, path, token, errormessage):
+        self.errors.append(f"{path}: Line {token.line}, column {token.column}: " + errormessage)
+
+class DiskCache():
+    """Lexing and parsing results stored on disk, addressed by the content digest and the version of pad.py."""
+    fingerprint = None
+
+    def __init__(self, folder, max_size = 512 * 1024 * 1024, max_age = 30 * 24 * 3600):
+        self.folder = folder
+        self.max_size = max_size
+        self.max_age = max_age
+        if DiskCache.fingerprint is None:
+            DiskCache.fingerprint = hashlib.sha256(Path(__file__).read_bytes() + sys.version.encode()).hexdigest()
+
+    def get_path(self, kind, digest):
+        key = hashlib.sha256(f"{DiskCache.fingerprint}/{kind}/{digest}".encode()).hexdigest()
+        return os.path.join(self.folder, key[:2], key)
+
+    def get(self, kind, digest):
+        path = self.get_path(kind, digest)
+        try:
+            with open(path, 'rb') as file:
+                data = marshal.loads(zlib.decompress(file.read()))
+            os.utime(path)
+            return data
+        except (OSError, EOFError, ValueError, TypeError, zlib.error):
+            return None
+
+    def set(self, kind, digest, data):
+        path = self.get_path(kind, digest)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        handle, temp_path = tempfile.mkstemp(dir = os.path.dirname(path), prefix = ".tmp")
+        try:
+            with os.fdopen(handle, 'wb') as file:
+                file.write(zlib.compress(marshal.dumps(data), 1))
+            os.replace(temp_path, path) # atomic, concurrent writers of the same entry write the same content
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def evict(self):
+        entries = []
+        limit = time.time() - self.max_age
+        for folder, folders, names in os.walk(self.folder):
+            for name in names:
+                path = os.path.join(folder, name)
+                try:
+                    stat = os.stat(path)
+                    if stat.st_mtime < limit:
+                        os.remove(path)
+                    else:
+                        entries.append((stat.st_mtime, stat.st_size, path))
+                except OSError:
+                    pass
+        size = sum(entry[1] for entry in entries)
+        for mtime, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= entry_size
+
+    @staticmethod
+    def dump_rows(rows):
+        return [ [ (t.name, t.type, t.value, t.line, t.column) for t in row ] for row in rows ]
+
+    @staticmethod
+    def load_rows(data):
+        return [ [ Token(name, type, value, line - 1, column - 1) for name, type, value, line, column in row ] for row in data ]
+
+    @staticmethod
+    def dump_parser(parser, rows):
+        indexes = { id(token): index for index, token in enumerate(token for row in rows for token in row) }
+        identified = {}
+        for name, store in parser.identified.items():
+            if name == "#ref":
+                identified[name] = { ref_name: [ indexes[id(token)] for token in references ] for ref_name, references in store.items() }
+            else:
+                identified[name] = [ (instruction.line, instruction.name, instruction.value, instruction.args) for instruction in store ]
+        return identified, parser.errors, parser.stopped_row
+
+    @staticmethod
+    def load_parser(parser, data, rows):
+        tokens = [ token for row in rows for token in row ]
+        identified, parser.errors, parser.stopped_row = data
+        for name, store in identified.items():
+            if name == "#ref":
+                parser.identified[name] = { ref_name: [ tokens[index] for index in references ] for ref_name, references in store.items() }
+            else:
+                instructions = parser.get_identified_list(name)
+                for line, instruction_name, value, args in store:
+                    instruction = Instruction(name, line)
+                    instruction.name, instruction.value, instruction.args = instruction_name, value, [ tuple(arg) for arg in args ]
+                    instructions.append(instruction)
+
 def to_array(string):
     if string is None:
         return None
@@ -229,14 +767,12 @@ def to_array(string):
 
 class Branch():
     def __init__(self, token, line, started):
-        self.scope = {}
         self.token = token
         self.line = line
         self.started = started
 
 class BranchControl():
     def __init__(self, stop_branch = False, create_branch = False, create_started_branch = False, parent_token_names = None, start_parent = False):
-        self.scope = {}
         self.stop_branch = stop_branch
         self.create_branch = create_branch or create_started_branch
         self.create_started_branch = create_started_branch
@@ -244,60 +780,103 @@ class BranchControl():
         self.parent_token_names = to_array(parent_token_names)
 
 class LinkedInst():
-    def __init__(self, token_type = None, allowed_list = None, is_end = False, set_name = False, set_value = False):
-        self.token_type = token_type
+    def __init__(self, token_type = None, allowed_list = None, is_end = False, set_name = False, set_value = False,
+                 add_arg = False, set_modifier = False, set_type = None):
+        self.token_type = token_type # None: any token
         self.any = allowed_list is None
         self.allowed_list = to_array(allowed_list)
         self.is_end = is_end
         self.set_name = set_name
         self.set_value = set_value
+        self.add_arg = add_arg
+        self.set_modifier = set_modifier
+        self.set_type = set_type
         self.nexts = []
+        self.next_names = {} # (token type, token name) => next
+        self.next_types = {} # token type => next, for any name
+        self.next_any = None # next for any token
 
     def add_next(self, next):
         self.nexts.append(next)
 
+    def compile(self, compiled = None):
+        """Build the transition tables of this node and of all the nodes reachable from it.
+        When several nexts accept a token, a next for the token name wins over a next for any name of the type."""
+        compiled = set() if compiled is None else compiled
+        if self in compiled:
+            return
+        compiled.add(self)
+        for elem in self.nexts:
+            if elem.token_type is None:
+                self.next_any = self.next_any or elem
+            elif elem.any:
+                self.next_types.setdefault(elem.token_type, elem)
+            else:
+                for name in elem.allowed_list:
+                    self.next_names.setdefault((elem.token_type, name), elem)
+            elem.compile(compiled)
+
     def get_next(self, token, instruction):
         result = self._get_next(token)
-        if result and (result.set_name or result.set_value):
-            if instruction.line is None:
-                instruction.line = token.line 
-            if result.set_name:
-                instruction.name = token.name
-            if result.set_value:
-                instruction.value = token.value 
+        if result:
+            result.apply(token, instruction)
         return result
 
     def _get_next(self, token):
-        for elem in self.nexts:
-            if token.type == elem.token_type:
-                if elem.any:
-                    return elem
-                if token.name in elem.allowed_list:
-                    return elem
-        return None
+        return self.next_names.get((token.type, token.name)) or self.next_types.get(token.type) or self.next_any
+
+    def apply(self, token, instruction):
+        if self.set_type:
+            instruction.type = self.set_type
+        if self.set_name:
+            instruction.name = token.name
+        if self.set_value:
+            instruction.value = token.value
+        if self.set_modifier:
+            instruction.modifier = token.name
+        if self.add_arg:
+            instruction.args.append((token.name, instruction.modifier))
+            instruction.modifier = None
 
 class InstructionRules():
+    access_modifiers = [ "public", "private" ]
+
     def __init__(self):
         self.rules = {}
-        self.rules["function"] = self._get_rule_function()
+        self.start = LinkedInst()
+        self.add_rule("function", self._get_rule_function("function"))
+        self.add_rule("sub", self._get_rule_function("sub"))
+        self.add_rule("dim", self._get_rule_dim())
+        self.add_rule("set", self._get_rule_set())
+        self.add_rule("call", self._get_rule_call())
+        self.add_rule("for each", self._get_rule_for_each())
+        self.add_rule("for", self._get_rule_for())
+        self.add_rule("do while", self._get_rule_do_while())
+        self.add_rule("assign", self._get_rule_assign())
+        self.add_rule("access", self._get_rule_access())
+        self.start.compile()
+
+    def add_rule(self, name, rule):
+        self.rules[name] = rule
+        self.start.add_next(rule)
     
     def identify(self, tokens):
-        if len(tokens) > 0 and tokens[0].name == "function":
-            return self.rules["function"]
+        if len(tokens) > 0:
+            return self.start._get_next(tokens[0])
 
-    def _get_rule_function(self):
-        function = LinkedInst("function")
+    def _get_rule_function(self, keyword):
+        function = LinkedInst(Token.KEYWORD, keyword, set_type = keyword)
 
-        function_name_idenfier = LinkedInst(Token.IDENTIFIER, set_name = True)
+        function_name_idenfier = LinkedInst(Token.IDENTIFIER, set_name = True, is_end = True)
         function.add_next(function_name_idenfier)
 
         left_parenthesis = LinkedInst(Token.OPERATOR, "(")
         function_name_idenfier.add_next(left_parenthesis)
 
-        by = LinkedInst(Token.KEYWORD, ["byval", "byref"])
+        by = LinkedInst(Token.KEYWORD, ["byval", "byref"], set_modifier = True)
         left_parenthesis.add_next(by)
 
-        idenfier = LinkedInst(Token.IDENTIFIER)
+        idenfier = LinkedInst(Token.IDENTIFIER, add_arg = True)
         left_parenthesis.add_next(idenfier)# byval/byref optional
         by.add_next(idenfier)
         
@@ -312,11 +891,163 @@ class InstructionRules():
 
         return function
 
+    def _get_rule_dim(self):
+        dim = LinkedInst(Token.KEYWORD, "dim", set_type = "dim")
+
+        first_idenfier = LinkedInst(Token.IDENTIFIER, set_name = True, add_arg = True, is_end = True)
+        dim.add_next(first_idenfier)
+        idenfier = LinkedInst(Token.IDENTIFIER, add_arg = True, is_end = True)
+
+        comma = LinkedInst(Token.OPERATOR, ",")
+        first_idenfier.add_next(comma)
+        idenfier.add_next(comma)
+        comma.add_next(idenfier)
+
+        left_parenthesis = LinkedInst(Token.OPERATOR, "(") # array bounds
+        first_idenfier.add_next(left_parenthesis)
+        idenfier.add_next(left_parenthesis)
+        bound = LinkedInst(Token.NUMBER)
+        bound_constant = LinkedInst(Token.IDENTIFIER)
+        left_parenthesis.add_next(bound)
+        left_parenthesis.add_next(bound_constant)
+        bound_comma = LinkedInst(Token.OPERATOR, ",")
+        bound.add_next(bound_comma)
+        bound_constant.add_next(bound_comma)
+        bound_comma.add_next(bound)
+        bound_comma.add_next(bound_constant)
+
+        right_parenthesis = LinkedInst(Token.OPERATOR, ")", is_end = True)
+        left_parenthesis.add_next(right_parenthesis) # dynamic array
+        bound.add_next(right_parenthesis)
+        bound_constant.add_next(right_parenthesis)
+        right_parenthesis.add_next(comma)
+
+        return dim
+
+    def _get_rule_set(self):
+        set = LinkedInst(Token.KEYWORD, "set", set_type = "set")
+
+        equal = LinkedInst(Token.OPERATOR, "=")
+        equal.add_next(self._get_expression())
+        set.add_next(self._get_target(equal))
+
+        return set
+
+    def _get_rule_call(self):
+        call = LinkedInst(Token.KEYWORD, "call", set_type = "call")
+        call.add_next(self._get_target(self._get_expression()))
+        return call
+
+    def _get_rule_for_each(self):
+        for_each = LinkedInst(Token.KEYWORD, "for each", set_type = "for each")
+
+        idenfier = LinkedInst(Token.IDENTIFIER, set_name = True)
+        for_each.add_next(idenfier)
+
+        keyword_in = LinkedInst(Token.KEYWORD, "in")
+        idenfier.add_next(keyword_in)
+        keyword_in.add_next(self._get_expression())
+
+        return for_each
+
+    def _get_rule_for(self):
+        rule_for = LinkedInst(Token.KEYWORD, "for", set_type = "for")
+
+        idenfier = LinkedInst(Token.IDENTIFIER, set_name = True)
+        rule_for.add_next(idenfier)
+
+        equal = LinkedInst(Token.OPERATOR, "=")
+        idenfier.add_next(equal)
+        equal.add_next(self._get_expression())
+
+        return rule_for
+
+    def _get_rule_do_while(self):
+        do_while = LinkedInst(Token.KEYWORD, "do while", set_type = "do while")
+        do_while.add_next(self._get_expression())
+        return do_while
+
+    def _get_rule_assign(self):
+        # identifier starting a row: assignment, or call without the call keyword
+        idenfier = LinkedInst(Token.IDENTIFIER, set_name = True, set_type = "call", is_end = True)
+
+        dot = LinkedInst(Token.OPERATOR, ".")
+        member = LinkedInst(Token.IDENTIFIER, is_end = True)
+        idenfier.add_next(dot)
+        dot.add_next(member)
+        member.add_next(dot)
+
+        equal = LinkedInst(Token.OPERATOR, "=", set_type = "assign")
+        idenfier.add_next(equal)
+        member.add_next(equal)
+        equal.add_next(self._get_expression())
+
+        index_left, index_right = self._get_parentheses() # name(index) = value, or call with arguments
+        idenfier.add_next(index_left)
+        member.add_next(index_left)
+        index_right.add_next(dot)
+        index_right.add_next(equal)
+        index_right.add_next(index_left)
+
+        arguments = self._get_expression()
+        idenfier.add_next(arguments)
+        member.add_next(arguments)
+        index_right.add_next(arguments)
+
+        return idenfier
+
+    def _get_target(self, *nexts):
+        # object or variable name, with its members: name(.name)*
+        idenfier = LinkedInst(Token.IDENTIFIER, set_name = True, is_end = True)
+
+        dot = LinkedInst(Token.OPERATOR, ".")
+        member = LinkedInst(Token.IDENTIFIER, is_end = True)
+        idenfier.add_next(dot)
+        dot.add_next(member)
+        member.add_next(dot)
+
+        for next in nexts:
+            idenfier.add_next(next)
+            member.add_next(next)
+        return idenfier
+
+    def _get_rule_access(self):
+        # public/private before function or sub, otherwise an identifier like the others
+        access = LinkedInst(Token.IDENTIFIER, InstructionRules.access_modifiers, set_name = True, set_type = "call", is_end = True)
+        access.nexts = [ self.rules["function"], self.rules["sub"] ] + self.rules["assign"].nexts
+        return access
+
+    def _get_parentheses(self, depth = 3):
+        # ( any tokens, with up to depth levels of nested parentheses ), returns the ( and ) nodes
+        left = LinkedInst(Token.OPERATOR, "(")
+        inside = LinkedInst()
+        right = LinkedInst(Token.OPERATOR, ")", is_end = True)
+        for node in [ left, inside ]:
+            node.add_next(right)
+            node.add_next(inside)
+        if depth > 0:
+            nested_left, nested_right = self._get_parentheses(depth - 1)
+            left.add_next(nested_left)
+            inside.add_next(nested_left)
+            nested_right.add_next(right)
+            nested_right.add_next(nested_left)
+            nested_right.add_next(inside)
+        return left, right
+
+    def _get_expression(self):
+        # any tokens until the end of the row
+        expression = LinkedInst(is_end = True)
+        expression.add_next(expression)
+        return expression
+
 class Instruction():
-     def __init__(self):
-        self.line = None
+     def __init__(self, type = None, line = None):
+        self.type = type
+        self.line = line
         self.name = None
         self.value = None
+        self.args = [] # (name, byval/byref modifier or None)
+        self.modifier = None
 
 class Parser():
     branch_controls = {
@@ -326,106 +1057,240 @@ class Parser():
         "else": BranchControl(stop_branch = True, create_started_branch = True, parent_token_names = ["if", "elseif"]),
         "end if": BranchControl(stop_branch = True, parent_token_names = ["if", "else", "elseif"]),
         "for each": BranchControl(create_started_branch = True),
-        "next": BranchControl(stop_branch = True, parent_token_names = "for each"),
+        "for": BranchControl(create_started_branch = True),
+        "next": BranchControl(stop_branch = True, parent_token_names = ["for each", "for"]),
         "do while": BranchControl(create_started_branch = True),
         "loop": BranchControl(stop_branch = True, parent_token_names = "do while"),
         "function": BranchControl(create_started_branch = True, parent_token_names = ""),
         "end function": BranchControl(stop_branch = True, parent_token_names = "function"),
         "sub": BranchControl(create_started_branch = True, parent_token_names = ""),
-        "end sub": BranchControl(stop_branch = True, parent_token_names = "function"),
+        "end sub": BranchControl(stop_branch = True, parent_token_names = "sub"),
     }
     instruction_rules = InstructionRules()
 
-    def __init__(self):
+    def __init__(self, incremental = False, stats = None, max_errors = 1, row_paths = None):
         self.errors = []
+        self.row_paths = row_paths # file of each row (IncludeResolver.row_paths), errors then start with the file of their token
+        self.max_errors = max_errors # parsing goes on after an error, repairing the open branches, until this count
         self.identified = {}
+        self.open_branches = []
+        self.row_index = 0
+        self.stopped_row = None
+        self.checkpoints = [] if incremental else None # (open branches, number of errors) at the start of each row
+        self.stats = stats
+        if stats:
+            self.parse = stats.timed("parse", self.parse)
+            self.match_rule = stats.summed("rules", self.match_rule)
     
-    def parse(self, tokens):
-        open_branches = []
+    def parse(self, tokens, first_row = 0):
+        if first_row == 0:
+            self.open_branches = []
+            self.row_index = 0
+        self.stopped_row = None
+        for tokens_row in itertools.islice(tokens, first_row, None):
+            if not self.parse_row(tokens_row):
+                self.stopped_row = self.row_index - 1
+                break
+        else:
+            self.parse_end()
+        if self.stats:
+            self.stats.stop_sum("rules")
+
+    def update(self, tokens, first_row):
+        """Parse again the rows from first_row, starting from the open branches recorded
+        before that row by the previous parse (requires an incremental parser)."""
+        if self.stopped_row is not None and first_row > self.stopped_row:
+            return
+        if first_row == 0 or first_row >= len(self.checkpoints):
+            self.errors = []
+            self.identified = {}
+            self.checkpoints = []
+            return self.parse(tokens)
+
+        branches, errors_count = self.checkpoints[first_row]
+        del self.checkpoints[first_row:]
+        self.open_branches = [ Branch(token, line, started) for token, line, started in branches ]
+        self.row_index = first_row
+        del self.errors[errors_count:]
+
+        last_line = 0
+        for tokens_row in reversed(tokens[:first_row]):
+            if len(tokens_row) > 0:
+                last_line = tokens_row[-1].line
+                break
+        for name in list(self.identified):
+            store = self.identified[name]
+            if name == "#ref":
+                for ref_name in list(store):
+                    references = store[ref_name]
+                    while len(references) > 0 and references[-1].line > last_line:
+                        references.pop()
+                    if len(references) == 0:
+                        del store[ref_name]
+            else:
+                while len(store) > 0 and (store[-1].line is None or store[-1].line > last_line):
+                    store.pop()
+            if len(store) == 0:
+                del self.identified[name]
+        self.parse(tokens, first_row)
+
+    def parse_row(self, tokens_row):
+        if self.checkpoints is not None:
+            self.checkpoints.append((tuple((b.token, b.line, b.started) for b in self.open_branches), len(self.errors)))
+        open_branches = self.open_branches
         current_branch = None
-        for i, tokens_row in enumerate(tokens):
-            for j, token in enumerate(tokens_row):
-                current_branch = open_branches[-1] if len(open_branches) > 0 else None
-                
-                if token.type == Token.KEYWORD:
-
-                    branch_control = Parser.branch_controls.get(token.name)
-                    if branch_control:
-
-                        is_parent_in_list = True
-                        if branch_control.parent_token_names:
-                            if current_branch:
-                                is_parent_in_list = current_branch.token.name in branch_control.parent_token_names
+        i = self.row_index
+        self.row_index += 1
+        for j, token in enumerate(tokens_row):
+            current_branch = open_branches[-1] if len(open_branches) > 0 else None
+            
+            if token.type == Token.KEYWORD:
+
+                branch_control = Parser.branch_controls.get(token.name)
+                if branch_control:
+
+                    is_parent_in_list = True
+                    if branch_control.parent_token_names:
+                        if current_branch:
+                            is_parent_in_list = current_branch.token.name in branch_control.parent_token_names
+                        else:
+                            is_parent_in_list = "" in branch_control.parent_token_names
+
+                    if branch_control.stop_branch:
+                        if current_branch:
+                            if is_parent_in_list:
+                                if not current_branch.started:
+                                    self.set_error(token, f"not valid for close because parent '{current_branch.token.name}' is not started")
+                                    if not self.can_recover():
+                                        return False
+                                    current_branch.started = True # repair, then close it as usual
+                                open_branches.pop()
                             else:
-                                is_parent_in_list = "" in branch_control.parent_token_names
-
-                        if branch_control.stop_branch:
-                            if current_branch:
-                                if is_parent_in_list:
-                                    if current_branch.started:
-                                        open_branches.pop()
-                                    else:
-                                        self.set_error(token, f"not valid for close because parent '{current_branch.token.name}' is not started")
-                                        return
+                                self.set_error(token, f"not valid for close because parent '{current_branch.token.name}' doesn't allow it")
+                                if not self.can_recover():
+                                    return False
+                                current_branch = self.close_nearest(branch_control)
+                                if not current_branch:
+                                    continue # nothing to close, ignore the token
+                                is_parent_in_list = True
+                        else:
+                            self.set_error(token, f"not valid for close because no parent found")
+                            if not self.can_recover():
+                                return False
+                            continue
+                    
+                    if branch_control.start_parent:
+                        if current_branch:
+                            if is_parent_in_list:
+                                if not current_branch.started:
+                                    current_branch.started = True
                                 else:
-                                    self.set_error(token, f"not valid for close because parent '{current_branch.token.name}' doesn't allow it")
-                                    return
+                                    self.set_error(token, f"not valid for start because parent '{current_branch.token.name}' is already started")
+                                    if not self.can_recover():
+                                        return False
                             else:
-                                self.set_error(token, f"not valid for close because no parent found")
-                                return
+                                self.set_error(token, f"not valid for start because parent '{current_branch.token.name}' doesn't allow it")
+                                if not self.can_recover():
+                                    return False
+                        else:
+                            self.set_error(token, f"not valid for start because no parent found")
+                            if not self.can_recover():
+                                return False
                         
-                        if branch_control.start_parent:
-                            if current_branch:
-                                if is_parent_in_list:
-                                    if not current_branch.started:
-                                        current_branch.started = True
-                                    else:
-                                        self.set_error(token, f"not valid for start because parent '{current_branch.token.name}' is already started")
-                                        return
-                                else:
-                                    self.set_error(token, f"not valid for start because parent '{current_branch.token.name}' doesn't allow it")
-                                    return
-                            else:
-                                self.set_error(token, f"not valid for start because no parent found")
-                                return
-                            
-                        if branch_control.create_branch:
-                            if is_parent_in_list:
-                                if not current_branch or current_branch.started:
-                                    open_branches.append(Branch(token, i, branch_control.create_started_branch))
-                                else:
-                                    self.set_error(token, f"not valid for create because parent '{current_branch.token.name}' not started")
-                                    return
+                    if branch_control.create_branch:
+                        if is_parent_in_list:
+                            if not current_branch or current_branch.started:
+                                open_branches.append(Branch(token, i, branch_control.create_started_branch))
+                                if self.stats:
+                                    self.stats.count_branch(open_branches)
                             else:
-                                self.set_error(token, f"not valid for create because parent '{current_branch.token.name}' doesn't allow it")
-                                return
-                    else:
-                        if current_branch and not current_branch.started:
-                            self.set_error(token, f"wrong position because parent '{current_branch.token.name}' not started")
-                            return
-                
-                elif token.type == Token.IDENTIFIER:
-                    references = self.get_identified_dic("#ref")
-                    references[token.name] = references.get(token.name, [])
-                    references[token.name].append(token)
+                                self.set_error(token, f"not valid for create because parent '{current_branch.token.name}' not started")
+                                if not self.can_recover():
+                                    return False
+                                current_branch.started = True # repair, then create it as usual
+                                open_branches.append(Branch(token, i, branch_control.create_started_branch))
+                        else:
+                            self.set_error(token, f"not valid for create because parent '{current_branch.token.name}' doesn't allow it")
+                            if not self.can_recover():
+                                return False
+                            open_branches.append(Branch(token, i, branch_control.create_started_branch)) # keep its closing in sync
+                else:
+                    if current_branch and not current_branch.started:
+                        self.set_error(token, f"wrong position because parent '{current_branch.token.name}' not started")
+                        if not self.can_recover():
+                            return False
             
-            if len(tokens_row) > 0:
-                rule = self.instruction_rules.identify(tokens_row)
-                if rule:
-                    instruction = Instruction()
-                    store = self.get_identified_list(rule.token_type)
-                    store.append(instruction)
-                    for token in tokens_row[1:]:
-                        rule = rule.get_next(token, instruction)
-                        if not rule:
-                            self.set_error(token, "invalid syntax")
-                            return
-        if len(open_branches) > 0:
-            for branch in open_branches:
-                self.set_error(branch.token, f"close missing")
+            elif token.type == Token.IDENTIFIER:
+                references = self.get_identified_dic("#ref")
+                references[token.name] = references.get(token.name, [])
+                references[token.name].append(token)
+        
+        if len(tokens_row) > 0:
+            return self.match_rule(tokens_row) or self.can_recover() # resync at the next row
+        return True
+
+    def can_recover(self):
+        return len(self.errors) < self.max_errors
+
+    def close_nearest(self, branch_control):
+        """Close the branches above the nearest one allowed by branch_control, return that branch."""
+        for k in range(len(self.open_branches) - 1, -1, -1):
+            if self.open_branches[k].token.name in branch_control.parent_token_names:
+                branch = self.open_branches[k]
+                del self.open_branches[k:]
+                return branch
+        return None
+
+    def match_rule(self, tokens_row):
+        for statement in Parser.split_statements(tokens_row):
+            instruction, error_token = Parser.read_instruction(statement)
+            if instruction:
+                self.get_identified_list(instruction.type).append(instruction)
+            if error_token:
+                self.set_error(error_token, "invalid syntax")
+                if not self.can_recover():
+                    return False
+        return True
+
+    @staticmethod
+    def split_statements(tokens_row):
+        """Statements of a row: the tokens between static text, includes and ':' separators."""
+        statement = []
+        for token in tokens_row:
+            if token.type == Token.PRINTMODE or token.type == Token.PRINTINCFILE or (token.type == Token.OPERATOR and token.name == ":"):
+                if len(statement) > 0:
+                    yield statement
+                statement = []
+            else:
+                statement.append(token)
+        if len(statement) > 0:
+            yield statement
+
+    @staticmethod
+    def read_instruction(tokens_row):
+        """Instruction of the first rule matching tokens_row (None if no rule applies), and the token where the rule failed (None if it didn't)."""
+        rule = Parser.instruction_rules.identify(tokens_row)
+        if not rule:
+            return None, None
+        instruction = Instruction(line = tokens_row[0].line)
+        rule.apply(tokens_row[0], instruction)
+        for token in tokens_row[1:]:
+            rule = rule.get_next(token, instruction)
+            if not rule:
+                return instruction, token
+        return instruction, None
+
+    def parse_end(self):
+        for branch in self.open_branches:
+            if self.max_errors > 1 and not self.can_recover(): # first error mode: every close missing, as before
+                return
+            self.set_error(branch.token, f"close missing", branch.line)
     
-    def set_error(self, token, errormessage):
-        self.errors.append(f"Line {token.line}, column {token.column }, token '{token.name}': " + errormessage)
+    def set_error(self, token, errormessage, row = None):
+        file = ""
+        if self.row_paths:
+            file = self.row_paths[self.row_index - 1 if row is None else row] + ": "
+        self.errors.append(f"{file}Line {token.line}, column {token.column }, token '{token.name}': " + errormessage)
     
     def print_errors(self):
         if len(self.errors) > 0:
@@ -443,19 +1308,1511 @@ class Parser():
             self.identified[name] = {}
         return self.identified[name]
 
+class SymbolIndex():
+    """Definitions (function, sub, dim) and references of every file of a project, by name and by position."""
+    definition_types = [ "function", "sub", "dim" ]
+
+    def __init__(self):
+        self.files = {} # path => (definitions, references) as lists of (name, type, line, column)
+        self.definitions = {} # name => { path => [ (type, line, column) ] }
+        self.references = {} # name => { path => [ (line, column) ] }
+        self.positions = {} # path => (sorted (line, column) keys, [ (end column, name, type) ])
+
+    def index_file(self, path, lexer_class = Lexer):
+        with open(path, 'r') as file:
+            lexer = lexer_class()
+            lexer.lex(file)
+        parser = Parser()
+        parser.parse(lexer.source_tokens)
+        self.update_file(path, parser.identified)
+
+    def update_file(self, path, identified):
+        self.remove_file(path)
+        self.add_file(path, *SymbolIndex.get_symbols(identified))
+
+    @staticmethod
+    def get_symbols(identified):
+        """Definitions and references of Parser.identified, as lists of (name, type, line, column) for add_file."""
+        references = identified.get("#ref", {})
+        definitions = []
+        definition_tokens = set()
+        for type in SymbolIndex.definition_types:
+            for instruction in identified.get(type, []):
+                names = [ arg[0] for arg in instruction.args ] if type == "dim" else [ instruction.name ]
+                for name in names:
+                    token = next((t for t in references.get(name, []) if t.line == instruction.line and not id(t) in definition_tokens), None)
+                    if token:
+                        definition_tokens.add(id(token))
+                        definitions.append((name, type, token.line, token.column))
+        symbols = [ (name, None, t.line, t.column) for name, tokens in references.items() for t in tokens if not id(t) in definition_tokens ]
+        return definitions, symbols
+
+    def add_file(self, path, definitions, references):
+        self.files[path] = (definitions, references)
+        for name, type, line, column in definitions:
+            self.definitions.setdefault(name, {}).setdefault(path, []).append((type, line, column))
+        for name, type, line, column in references:
+            self.references.setdefault(name, {}).setdefault(path, []).append((line, column))
+        spans = sorted((line, column, column + len(name), name, type) for name, type, line, column in definitions + references)
+        self.positions[path] = ([ span[:2] for span in spans ], [ span[2:] for span in spans ])
+
+    def remove_file(self, path):
+        if not path in self.files:
+            return
+        definitions, references = self.files.pop(path)
+        del self.positions[path]
+        for names, symbols in [ (self.definitions, definitions), (self.references, references) ]:
+            for name, type, line, column in symbols:
+                paths = names.get(name)
+                if paths and path in paths:
+                    del paths[path]
+                    if len(paths) == 0:
+                        del names[name]
+
+    def find_definitions(self, name):
+        paths = self.definitions.get(name.lower(), {})
+        return sorted((path, type, line, column) for path, symbols in paths.items() for type, line, column in symbols)
+
+    def find_references(self, name):
+        paths = self.references.get(name.lower(), {})
+        return sorted((path, line, column) for path, symbols in paths.items() for line, column in symbols)
+
+    def find_at(self, path, line, column):
+        """Name and definition type (None for a reference) of the symbol at line/column (1-based) of path."""
+        keys, spans = self.positions.get(path, ([], []))
+        i = bisect.bisect_right(keys, (line, column)) - 1
+        if i >= 0 and keys[i][0] == line and column < spans[i][0]:
+            return spans[i][1], spans[i][2]
+        return None
+
+    def save(self, file_name):
+        with open(file_name, 'wb') as file:
+            file.write(zlib.compress(marshal.dumps(self.files), 1))
+
+    def load(self, file_name):
+        with open(file_name, 'rb') as file:
+            files = marshal.loads(zlib.decompress(file.read()))
+        for path, (definitions, references) in files.items():
+            self.remove_file(path)
+            self.add_file(path, definitions, references)
+
+class Empty():
+    """Value of the variables never assigned: "" in strings, 0 in numbers, False in conditions."""
+    __slots__ = ()
+
+    @staticmethod
+    def like(other):
+        return "" if isinstance(other, str) else 0
+
+    def __repr__(self):
+        return "Empty"
+
+    def __format__(self, format_spec):
+        return ""
+
+    def __bool__(self):
+        return False
+
+    def __hash__(self):
+        return 0
+
+    def __eq__(self, other):
+        return isinstance(other, Empty) or Empty.like(other) == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __lt__(self, other):
+        return Empty.like(other) < other
+
+    def __le__(self, other):
+        return Empty.like(other) <= other
+
+    def __gt__(self, other):
+        return Empty.like(other) > other
+
+    def __ge__(self, other):
+        return Empty.like(other) >= other
+
+    def __add__(self, other):
+        return other
+
+    def __radd__(self, other):
+        return other
+
+    def __sub__(self, other):
+        return -other
+
+    def __rsub__(self, other):
+        return other
+
+    def __mul__(self, other):
+        return 0
+
+    def __rmul__(self, other):
+        return 0
+
+    def __truediv__(self, other):
+        return Empty.like(other) / other
+
+    def __rtruediv__(self, other):
+        return other / Empty.like(other)
+
+    def __floordiv__(self, other):
+        return Empty.like(other) // other
+
+    def __rfloordiv__(self, other):
+        return other // Empty.like(other)
+
+    def __mod__(self, other):
+        return Empty.like(other) % other
+
+    def __rmod__(self, other):
+        return other % Empty.like(other)
+
+    def __pow__(self, other):
+        return Empty.like(other) ** other
+
+    def __rpow__(self, other):
+        return other ** Empty.like(other)
+
+    def __neg__(self):
+        return 0
+
+empty = Empty()
+
+class TranspileError(Exception):
+    def __init__(self, token, message):
+        super().__init__(message)
+        self.token = token
+
+class Statement():
+    """Node of the code tree: an instruction with its expressions as Python ast nodes and its nested statements."""
+    def __init__(self, type, token, instruction = None):
+        self.type = type # page, print, assign, call, dim, if, for each, for, do while, function, sub, break, return
+        self.token = token # first token, gives the .asp line and column of the generated code
+        self.instruction = instruction
+        self.target = None # assigned variable or loop variable
+        self.value = None # printed text, assigned value, call, loop collection or condition, returned value
+        self.range = [] # for: start, stop and step
+        self.branches = [] # if: [ (condition or None for else, statements) ]
+        self.body = []
+        self.scope = {} # page, function and sub: variable name => scope (Transpiler.resolve_scopes)
+
+class Transpiler():
+    """Python code of the token rows: builds the statement tree from the branch controls and the instruction rules of the
+    parser, turns it into Python ast nodes located at the .asp lines and columns, and compiles them to a code object.
+    Expects rows without parser errors and with the includes expanded (IncludeResolver)."""
+    runtime_names = [ "response", "request", "server", "session", "application", "empty" ] # provided by run_page
+    constants = { "true": True, "false": False, "nothing": None, "null": None }
+    segment_starts = [ name for name in Parser.branch_controls if name != "then" ] + [ "exit for", "exit do", "exit function", "exit sub" ]
+    segment_ends = [ "then", "else", "end if", "next", "loop", "end function", "end sub" ]
+    block_ends = { "end if": [ "if" ], "next": [ "for each", "for" ], "loop": [ "do while" ], "end function": [ "function" ], "end sub": [ "sub" ] }
+    operator_levels = [ # lowest precedence first: (binary operators, unary operators)
+        ({ "or": ast.Or }, {}),
+        ({ "and": ast.And }, {}),
+        ({}, { "not": ast.Not }),
+        ({ "=": ast.Eq, "==": ast.Eq, "<>": ast.NotEq, "!=": ast.NotEq, "<": ast.Lt, ">": ast.Gt, "<=": ast.LtE, ">=": ast.GtE }, {}),
+        ({ "&": ast.JoinedStr }, {}),
+        ({ "+": ast.Add, "-": ast.Sub }, {}),
+        ({ "mod": ast.Mod }, {}),
+        ({ "\\": ast.FloorDiv }, {}),
+        ({ "*": ast.Mult, "/": ast.Div }, {}),
+        ({}, { "-": ast.USub, "+": ast.UAdd }),
+        ({ "^": ast.Pow }, {}),
+    ]
+
+    binary_functions = {
+        ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv, ast.FloorDiv: operator.floordiv,
+        ast.Mod: operator.mod, ast.Pow: operator.pow, ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt,
+        ast.Gt: operator.gt, ast.LtE: operator.le, ast.GtE: operator.ge,
+    }
+    unary_functions = { ast.USub: operator.neg, ast.UAdd: operator.pos, ast.Not: operator.not_ }
+
+    def __init__(self, stats = None, optimize = True, lines = None, path = None):
+        self.errors = []
+        self.lines = lines or [] # lines of the include files, see map_include_lines
+        self.path = path # with a path, errors start with the file of their line
+        self.optimize = optimize
+        self.notes = [] # branches and loops removed by the optimizations
+        self.arrays = set() # names declared with dim bounds: name(i) reads an item instead of calling
+        self.functions = set() # names of the functions and subs of the page: name alone calls them
+        self.open_statements = []
+        self.tokens = []
+        self.position = 0
+        self.stats = stats
+        if stats:
+            self.transpile = stats.timed("transpile", self.transpile)
+
+    def transpile(self, tokens, path):
+        page = self.build(tokens)
+        if len(self.errors) > 0:
+            return None
+        if self.optimize:
+            page.body = self.coalesce(self.fold(page.body))
+        return compile(self.to_module(page), path, "exec")
+
+    def build(self, tokens):
+        page = Statement("page", None)
+        self.open_statements = [ page ]
+        tokens = list(tokens)
+        for tokens_row in tokens: # functions can be called before their definition
+            for token, next_token in zip(tokens_row, tokens_row[1:]):
+                if token.type == Token.KEYWORD and token.name in [ "function", "sub" ] and next_token.type == Token.IDENTIFIER:
+                    self.functions.add(next_token.name)
+        for tokens_row in tokens:
+            for segment in self.split_row(tokens_row):
+                try:
+                    self.add_segment(segment)
+                except TranspileError as err:
+                    self.set_error(err.token, str(err))
+        for statement in self.open_statements[1:]:
+            self.set_error(statement.token, "close missing")
+        return page
+
+    def split_row(self, tokens_row):
+        """Tokens of each statement of the row: static text, block keywords and the instructions between them."""
+        segment = []
+        for token in tokens_row:
+            if token.type == Token.OPERATOR and token.name == ":":
+                if len(segment) > 0:
+                    yield segment
+                segment = []
+                continue
+            is_keyword = token.type == Token.KEYWORD
+            if token.type == Token.PRINTMODE or token.type == Token.PRINTINCFILE or (is_keyword and token.name in Transpiler.segment_starts):
+                if is_keyword and token.name in [ "function", "sub" ] and Transpiler.is_access(segment):
+                    segment = [] # public/private function: the access doesn't change the Python code
+                if len(segment) > 0:
+                    yield segment
+                segment = []
+            segment.append(token)
+            if token.type == Token.PRINTMODE or token.type == Token.PRINTINCFILE or (is_keyword and token.name in Transpiler.segment_ends):
+                yield segment
+                segment = []
+        if len(segment) > 0:
+            yield segment
+
+    @staticmethod
+    def is_access(segment):
+        return len(segment) == 1 and segment[0].type == Token.IDENTIFIER and segment[0].name in InstructionRules.access_modifiers
+
+    def add_segment(self, segment):
+        token = segment[0]
+        name = token.name if token.type == Token.KEYWORD else None
+        if token.type == Token.PRINTMODE:
+            if len(token.value) == 0:
+                return # separator of two ASP blocks
+            statement = Statement("print", token)
+            statement.value = self.located(ast.Constant(token.value), token)
+            self.add(statement)
+        elif token.type == Token.PRINTINCFILE:
+            raise TranspileError(token, "include not expanded")
+        elif token.type == Token.OPERATOR and token.name == "=": # <%= expression %>
+            statement = Statement("print", token)
+            statement.value = self.read_expression(segment[1:], token)
+            self.add(statement)
+        elif name == "if":
+            statement = Statement("if", token)
+            statement.branches.append((self.read_condition(segment), []))
+            self.add(statement, True)
+        elif name == "elseif":
+            self.get_open(token, [ "if" ]).branches.append((self.read_condition(segment), []))
+        elif name == "else":
+            self.get_open(token, [ "if" ]).branches.append((None, []))
+        elif name in Transpiler.block_ends:
+            self.get_open(token, Transpiler.block_ends[name])
+            self.open_statements.pop()
+        elif name == "for each":
+            statement = Statement("for each", token)
+            names = [ t.name for t in segment ]
+            if len(segment) < 4 or segment[1].type != Token.IDENTIFIER or names[2] != "in":
+                raise TranspileError(token, "invalid syntax")
+            statement.target = self.located(ast.Name(segment[1].name, ast.Store()), segment[1])
+            statement.value = self.read_expression(segment[3:])
+            self.add(statement, True)
+        elif name == "for":
+            self.add(self.read_for(segment), True)
+        elif name == "do while":
+            statement = Statement("do while", token)
+            statement.value = self.read_expression(segment[1:], token)
+            self.add(statement, True)
+        elif name == "function" or name == "sub":
+            instruction, error_token = Parser.read_instruction(segment)
+            if error_token:
+                raise TranspileError(error_token, "invalid syntax")
+            self.add(Statement(name, token, instruction), True)
+        elif name == "exit for" or name == "exit do":
+            self.get_enclosing(token, [ "for", "for each" ] if name == "exit for" else [ "do while" ])
+            self.add(Statement("break", token))
+        elif name == "exit function" or name == "exit sub":
+            function = self.get_enclosing(token, [ name[5:] ])
+            statement = Statement("return", token)
+            if name == "exit function":
+                statement.value = self.located(ast.Name(function.instruction.name, ast.Load()), token)
+            self.add(statement)
+        elif name == "on error resume next":
+            pass # errors can't resume at the next statement in Python, the page stops at the first one
+        elif name == "dim":
+            self.read_dim(segment)
+        elif name == "set":
+            self.add(self.read_assignment(segment[1:], token))
+        elif name == "call":
+            self.add(self.read_call(segment[1:], token))
+        elif token.type == Token.IDENTIFIER:
+            if any(t.type == Token.OPERATOR and t.name == "=" for t in segment):
+                self.add(self.read_assignment(segment, token))
+            else:
+                self.add(self.read_call(segment, token))
+        else:
+            raise TranspileError(token, "not supported")
+
+    def add(self, statement, is_open = False):
+        parent = self.open_statements[-1]
+        (parent.branches[-1][1] if parent.type == "if" else parent.body).append(statement)
+        if is_open:
+            self.open_statements.append(statement)
+
+    def get_open(self, token, types):
+        statement = self.open_statements[-1]
+        if not statement.type in types:
+            raise TranspileError(token, f"not valid because parent '{statement.type}' doesn't allow it")
+        return statement
+
+    def get_enclosing(self, token, types):
+        for statement in reversed(self.open_statements):
+            if statement.type in types:
+                return statement
+        raise TranspileError(token, f"not valid outside of {' or '.join(types)}")
+
+    def read_condition(self, segment):
+        if segment[-1].name != "then" or len(segment) < 3:
+            raise TranspileError(segment[-1], "invalid syntax")
+        return self.read_expression(segment[1:-1])
+
+    def read_for(self, segment):
+        # for name = start to stop [step step]
+        statement = Statement("for", segment[0])
+        if len(segment) < 6 or segment[1].type != Token.IDENTIFIER or segment[2].name != "=":
+            raise TranspileError(segment[0], "invalid syntax")
+        statement.target = self.located(ast.Name(segment[1].name, ast.Store()), segment[1])
+        parts = [ [] ]
+        for token in segment[3:]:
+            if token.type == Token.IDENTIFIER and token.name == ("to" if len(parts) == 1 else "step"):
+                parts.append([])
+            else:
+                parts[-1].append(token)
+        if len(parts) < 2:
+            raise TranspileError(segment[0], "to missing")
+        statement.range = [ self.read_expression(part, segment[0]) for part in parts ]
+        if len(parts) == 3:
+            statement.range[2] = self.fold_expression(statement.range[2]) # its sign picks the stop, with or without optimize
+        if len(parts) == 3 and not (isinstance(statement.range[2], ast.Constant) or isinstance(statement.range[2], ast.UnaryOp)):
+            raise TranspileError(parts[2][0], "step must be a constant")
+        return statement
+
+    def read_dim(self, segment):
+        self.start(segment[1:], segment[0])
+        while True:
+            token = self.next_token()
+            if token.type != Token.IDENTIFIER:
+                raise TranspileError(token, "invalid syntax")
+            statement = Statement("dim", token)
+            statement.target = self.located(ast.Name(token.name, ast.Store()), token)
+            statement.value = self.located(ast.Name("empty", ast.Load()), token)
+            if self.is_next("("):
+                self.position += 1
+                self.arrays.add(token.name)
+                statement.value = self.get_array(self.read_arguments(), token)
+            self.add(statement)
+            if self.position == len(self.tokens):
+                return
+            if not self.is_next(","):
+                raise TranspileError(self.tokens[self.position], "invalid syntax")
+            self.position += 1
+
+    def get_array(self, bounds, token):
+        # dim a(2, 3): [ [ empty ] * (3 + 1) for _ in [ 0 ] * (2 + 1) ], no builtin needed
+        if len(bounds) == 0:
+            return self.located(ast.List([], ast.Load()), token)
+        def size(bound):
+            return self.located(ast.BinOp(bound, ast.Add(), ast.Constant(1)), token)
+        array = ast.BinOp(ast.List([ ast.Name("empty", ast.Load()) ], ast.Load()), ast.Mult(), size(bounds[-1]))
+        for bound in reversed(bounds[:-1]):
+            counter = ast.BinOp(ast.List([ ast.Constant(0) ], ast.Load()), ast.Mult(), size(bound))
+            array = ast.ListComp(array, [ ast.comprehension(ast.Name("_", ast.Store()), counter, [], 0) ])
+        return self.located(array, token)
+
+    def read_assignment(self, tokens, token):
+        equal = next((i for i, t in enumerate(tokens) if t.type == Token.OPERATOR and t.name == "="), None)
+        if equal is None:
+            raise TranspileError(token, "= missing")
+        statement = Statement("assign", token)
+        target = self.read_expression(tokens[:equal], token)
+        statement.target = self.to_store(target, tokens[0])
+        statement.value = self.read_expression(tokens[equal + 1:], tokens[equal])
+        return statement
+
+    def to_store(self, node, token):
+        if isinstance(node, ast.Name):
+            return self.located(ast.Name(node.id, ast.Store()), token)
+        if isinstance(node, ast.Attribute):
+            return ast.copy_location(ast.Attribute(node.value, node.attr, ast.Store()), node)
+        if isinstance(node, ast.Subscript):
+            return ast.copy_location(ast.Subscript(node.value, node.slice, ast.Store()), node)
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and len(node.args) > 0:
+            self.arrays.add(node.func.id) # only an array item can be assigned
+            return self.to_store(self.get_item(node.func, node.args), token)
+        raise TranspileError(token, "invalid assignment")
+
+    def read_call(self, tokens, token):
+        # name(args), name args or name
+        statement = Statement("call", token)
+        self.start(tokens, token)
+        call = self.read_primary(False)
+        if self.position < len(self.tokens) and not isinstance(call, ast.Call):
+            args = [ self.read_level(0) ]
+            while self.is_next(","):
+                self.position += 1
+                args.append(self.read_level(0))
+            call = ast.copy_location(ast.Call(call, args, []), call)
+        elif not isinstance(call, ast.Call):
+            call = ast.copy_location(ast.Call(call, [], []), call)
+        self.end_statement()
+        statement.value = call
+        return statement
+
+    def read_expression(self, tokens, token = None):
+        self.start(tokens, token)
+        expression = self.read_level(0)
+        self.end_statement()
+        return expression
+
+    def end_statement(self):
+        if self.position < len(self.tokens):
+            raise TranspileError(self.tokens[self.position], "invalid syntax")
+
+    def start(self, tokens, token):
+        if len(tokens) == 0:
+            raise TranspileError(token, "expression missing")
+        self.tokens = tokens
+        self.position = 0
+
+    def is_next(self, name):
+        return self.position < len(self.tokens) and self.tokens[self.position].type == Token.OPERATOR and self.tokens[self.position].name == name
+
+    def next_token(self):
+        if self.position == len(self.tokens):
+            raise TranspileError(self.tokens[-1], "expression incomplete")
+        self.position += 1
+        return self.tokens[self.position - 1]
+
+    def read_level(self, level):
+        if level == len(Transpiler.operator_levels):
+            return self.read_primary()
+        binary, unary = Transpiler.operator_levels[level]
+        token = self.tokens[self.position] if self.position < len(self.tokens) else None
+        if token and token.name in unary and (token.type == Token.OPERATOR or token.type == Token.KEYWORD):
+            self.position += 1
+            return self.located(ast.UnaryOp(unary[token.name](), self.read_level(level)), token)
+        left = self.read_level(level + 1)
+        while self.position < len(self.tokens):
+            token = self.tokens[self.position]
+            if not (token.name in binary and (token.type == Token.OPERATOR or token.type == Token.KEYWORD)):
+                break
+            self.position += 1
+            left = ast.copy_location(self.combine(binary[token.name], left, self.read_level(level + 1)), left)
+        return left
+
+    def combine(self, operator, left, right):
+        if operator is ast.JoinedStr:
+            return ast.JoinedStr(self.get_parts(left) + self.get_parts(right))
+        if operator is ast.And or operator is ast.Or:
+            if isinstance(left, ast.BoolOp) and isinstance(left.op, operator):
+                return ast.BoolOp(operator(), left.values + [ right ])
+            return ast.BoolOp(operator(), [ left, right ])
+        if issubclass(operator, ast.cmpop):
+            return ast.Compare(left, [ operator() ], [ right ]) # not chained: a = b = c is (a = b) = c
+        return ast.BinOp(left, operator(), right)
+
+    def get_parts(self, node):
+        # parts of a concatenation, merged into a single f-string
+        if isinstance(node, ast.JoinedStr):
+            return list(node.values)
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            return [ node ]
+        return [ ast.copy_location(ast.FormattedValue(node, -1, None), node) ]
+
+    def read_primary(self, calls = True):
+        token = self.next_token()
+        if token.type == Token.NUMBER:
+            try:
+                return self.located(ast.Constant(int(token.name) if token.name.isdigit() else float(token.name)), token)
+            except ValueError:
+                raise TranspileError(token, "invalid number")
+        if token.type == Token.STRING:
+            return self.located(ast.Constant(token.value), token)
+        if token.type == Token.OPERATOR and token.name == "(":
+            expression = self.read_level(0)
+            if not self.is_next(")"):
+                raise TranspileError(token, ") missing")
+            self.position += 1
+            return expression
+        if token.type != Token.IDENTIFIER:
+            raise TranspileError(token, "invalid expression")
+        if token.name in Transpiler.constants:
+            return self.located(ast.Constant(Transpiler.constants[token.name]), token)
+
+        node = self.located(ast.Name(token.name, ast.Load()), token)
+        if calls and token.name in self.functions and not self.is_next("(") and not self.is_result(token.name):
+            return ast.copy_location(ast.Call(node, [], []), node) # VbScript calls a function named without arguments
+        while True:
+            if self.is_next("."):
+                self.position += 1
+                member = self.next_token()
+                if not (member.type == Token.IDENTIFIER or member.type == Token.KEYWORD) or " " in member.name:
+                    raise TranspileError(member, "invalid member")
+                node = self.located(ast.Attribute(node, member.name, ast.Load()), member)
+            elif self.is_next("("):
+                self.position += 1
+                args = self.read_arguments()
+                if isinstance(node, ast.Name) and node.id in self.arrays and len(args) > 0:
+                    node = self.get_item(node, args)
+                else:
+                    node = ast.copy_location(ast.Call(node, args, []), node)
+            else:
+                return node
+
+    def is_result(self, name):
+        # in its own body, the name of a function is its result
+        return any(statement.type == "function" and statement.instruction.name == name for statement in self.open_statements)
+
+    def read_arguments(self):
+        args = []
+        if self.is_next(")"):
+            self.position += 1
+            return args
+        while True:
+            args.append(self.read_level(0))
+            token = self.next_token()
+            if token.type == Token.OPERATOR and token.name == ")":
+                return args
+            if token.type != Token.OPERATOR or token.name != ",":
+                raise TranspileError(token, "invalid arguments")
+
+    def get_item(self, node, indexes):
+        for index in indexes:
+            node = ast.copy_location(ast.Subscript(node, index, ast.Load()), node)
+        return node
+
+    def fold(self, statements):
+        """Fold the constant expressions, and remove the branches and loops whose condition is constant (noted in self.notes)."""
+        result = []
+        for statement in statements:
+            if statement.value is not None:
+                statement.value = self.fold_expression(statement.value)
+            if statement.target is not None:
+                statement.target = self.fold_expression(statement.target)
+            statement.range = [ self.fold_expression(node) for node in statement.range ]
+            statement.body = self.fold(statement.body)
+            if statement.type == "if":
+                result.extend(self.fold_branches(statement))
+            elif statement.type == "do while" and isinstance(statement.value, ast.Constant) and not statement.value.value:
+                self.set_note(statement.value, "loop removed, condition always false")
+            else:
+                result.append(statement)
+        return result
+
+    def fold_branches(self, statement):
+        branches = []
+        for index, (condition, body) in enumerate(statement.branches):
+            condition = None if condition is None else self.fold_expression(condition)
+            body = self.fold(body)
+            if isinstance(condition, ast.Constant):
+                if not condition.value:
+                    self.set_note(condition, "branch removed, condition always false")
+                    continue
+                if index < len(statement.branches) - 1:
+                    self.set_note(condition, f"{len(statement.branches) - index - 1} following branch(es) removed, condition always true")
+                condition = None
+            branches.append((condition, body))
+            if condition is None:
+                break
+        if len(branches) == 0:
+            return []
+        if branches[0][0] is None: # no condition left, the statements of the branch replace the if
+            return branches[0][1]
+        statement.branches = branches
+        return [ statement ]
+
+    def fold_expression(self, node):
+        for field, value in ast.iter_fields(node):
+            if isinstance(value, ast.AST):
+                setattr(node, field, self.fold_expression(value))
+            elif isinstance(value, list):
+                setattr(node, field, [ self.fold_expression(item) if isinstance(item, ast.AST) else item for item in value ])
+
+        # evaluated as the generated code would, left unchanged when it would fail or could build a huge value
+        try:
+            if isinstance(node, ast.BinOp) and self.is_foldable(node.left) and self.is_foldable(node.right):
+                left, right = node.left.value, node.right.value
+                if (isinstance(left, str) or isinstance(right, str)) and not isinstance(node.op, ast.Add):
+                    return node
+                if isinstance(node.op, ast.Pow) and abs(right) > 64:
+                    return node
+                value = Transpiler.binary_functions[type(node.op)](left, right)
+            elif isinstance(node, ast.UnaryOp) and isinstance(node.operand, ast.Constant):
+                value = Transpiler.unary_functions[type(node.op)](node.operand.value)
+            elif isinstance(node, ast.Compare) and self.is_foldable(node.left) and self.is_foldable(node.comparators[0]):
+                value = Transpiler.binary_functions[type(node.ops[0])](node.left.value, node.comparators[0].value)
+            elif isinstance(node, ast.BoolOp) and all(isinstance(item, ast.Constant) for item in node.values):
+                value = node.values[0].value
+                for item in node.values[1:]:
+                    value = (value and item.value) if isinstance(node.op, ast.And) else (value or item.value)
+            elif isinstance(node, ast.JoinedStr):
+                return self.fold_joined(node)
+            else:
+                return node
+        except (ArithmeticError, TypeError, ValueError):
+            return node
+        return ast.copy_location(ast.Constant(value), node)
+
+    def fold_joined(self, node):
+        values = []
+        for part in node.values:
+            if isinstance(part, ast.FormattedValue) and isinstance(part.value, ast.Constant):
+                part = ast.copy_location(ast.Constant(f"{part.value.value}"), part)
+            if isinstance(part, ast.Constant) and len(values) > 0 and isinstance(values[-1], ast.Constant):
+                values[-1] = ast.copy_location(ast.Constant(values[-1].value + part.value), values[-1])
+            else:
+                values.append(part)
+        if len(values) == 0:
+            return ast.copy_location(ast.Constant(""), node)
+        if len(values) == 1 and isinstance(values[0], ast.Constant):
+            return values[0]
+        node.values = values
+        return node
+
+    def is_foldable(self, node):
+        return isinstance(node, ast.Constant) and type(node.value) in [ int, float, str ]
+
+    def set_note(self, node, note):
+        self.notes.append(f"Line {node.lineno}, column {node.col_offset + 1}: " + note)
+
+    def coalesce(self, statements):
+        """Merge each run of consecutive constant writes (static text, <%= "text" %>, Response.Write "text") into a
+        single write of an interned constant."""
+        result = []
+        run = [] # (statement, text) of the current run
+        for statement in statements + [ None ]:
+            text = self.get_static_text(statement) if statement else None
+            if text is not None:
+                run.append((statement, text))
+                continue
+            if len(run) > 0:
+                first = run[0][0]
+                merged = Statement("print", first.token)
+                merged.value = ast.copy_location(ast.Constant(sys.intern("".join(text for s, text in run))), first.value)
+                result.append(merged)
+                run = []
+            if statement:
+                statement.body = self.coalesce(statement.body)
+                statement.branches = [ (condition, self.coalesce(body)) for condition, body in statement.branches ]
+                result.append(statement)
+        return result
+
+    def get_static_text(self, statement):
+        value = statement.value
+        if statement.type == "call":
+            function = value.func
+            if not (isinstance(function, ast.Attribute) and function.attr == "write" and isinstance(function.value, ast.Name)
+                    and function.value.id == "response" and len(value.args) == 1):
+                return None
+            value = value.args[0]
+        elif statement.type != "print":
+            return None
+        if isinstance(value, ast.Constant) and type(value.value) in [ str, int ]:
+            return f"{value.value}"
+        return None
+
+    def to_module(self, page):
+        """Python module of the page: the functions first (they can be called before their definition), the page
+        variables used by functions as module globals initialized to Empty, then the page statements in a function,
+        where the other page variables are fast locals."""
+        self.resolve_scopes(page)
+        functions = [ statement for statement in page.body if statement.type in [ "function", "sub" ] ]
+        body = [ self.function_to_ast(statement) for statement in functions ]
+        page_body = self.get_prologue(page.scope, page.body[0].token if len(page.body) > 0 else None)
+        page_body += self.body_to_ast([ statement for statement in page.body if not statement.type in [ "function", "sub" ] ])
+        arguments = ast.arguments([], [], None, [], [], None, [])
+        body.append(ast.FunctionDef("_page", arguments, page_body, [], None))
+        body.append(ast.Expr(ast.Call(ast.Name("_page", ast.Load()), [], [])))
+
+        global_names = sorted(set(name for scope in [ page.scope ] + [ statement.scope for statement in functions ]
+                                  for name, kind in scope.items() if kind == "global"))
+        if len(global_names) > 0:
+            body.insert(0, ast.Assign([ ast.Name(name, ast.Store()) for name in global_names ], ast.Name("empty", ast.Load())))
+        return ast.fix_missing_locations(ast.Module(body, []))
+
+    def resolve_scopes(self, page):
+        """Scope of every variable, in the scope dictionary of the page and of each function and sub statement.
+        In a function: byval / byref arguments, result (function name), dim, local (assigned without declaration and not
+        assigned by the page) or global. In the page: global when a function uses it, else local."""
+        functions = [ statement for statement in page.body if statement.type in [ "function", "sub" ] ]
+        function_names = set(statement.instruction.name for statement in functions)
+        excluded = function_names | set(Transpiler.runtime_names)
+        page_statements = [ statement for statement in page.body if not statement.type in [ "function", "sub" ] ]
+        page_assigned = self.get_assigned(page_statements) - excluded
+        page.scope = { name: "local" for name in page_assigned | (self.get_referenced(page_statements) - excluded) }
+
+        for function in functions:
+            instruction = function.instruction
+            scope = function.scope = {}
+            for name, modifier in instruction.args:
+                scope[name] = modifier or "byref" # VbScript default
+            if function.type == "function":
+                scope[instruction.name] = "result"
+            for statement in self.iter_statements(function.body):
+                if statement.type == "dim":
+                    scope.setdefault(statement.target.id, "dim")
+            for name in sorted(self.get_assigned(function.body)):
+                if not name in scope:
+                    scope[name] = "global" if name in page_assigned else "local" # only read by the page: Empty there
+                elif scope[name] == "byref":
+                    self.notes.append(f"Line {function.token.line}, column {function.token.column}, token '{function.token.name}': "
+                                      f"byref argument '{name}' is assigned, it is passed by value")
+            for name in sorted(self.get_referenced(function.body) - excluded):
+                scope.setdefault(name, "global")
+            for name, kind in scope.items():
+                if kind == "global" and name in page.scope:
+                    page.scope[name] = "global"
+
+    def get_referenced(self, statements):
+        names = set()
+        for statement in self.iter_statements(statements):
+            for node in [ statement.target, statement.value ] + statement.range + [ condition for condition, body in statement.branches ]:
+                if node is not None:
+                    names.update(child.id for child in ast.walk(node) if isinstance(child, ast.Name) and child.id[0] != "_")
+        return names
+
+    def get_prologue(self, scope, token):
+        # global declarations and locals initialized to Empty
+        body = []
+        global_names = sorted(name for name, kind in scope.items() if kind == "global")
+        local_names = sorted("_result" if kind == "result" else name for name, kind in scope.items() if not kind in [ "global", "byval", "byref" ])
+        if len(global_names) > 0:
+            body.append(ast.Global(global_names))
+        if len(local_names) > 0:
+            body.append(ast.Assign([ ast.Name(name, ast.Store()) for name in local_names ], ast.Name("empty", ast.Load())))
+        return [ self.located(node, token) for node in body ] if token else body
+
+    def get_assigned(self, statements):
+        names = set()
+        for statement in statements:
+            if statement.type in [ "function", "sub" ]:
+                continue
+            if isinstance(statement.target, ast.Name):
+                names.add(statement.target.id)
+            names |= self.get_assigned(statement.body)
+            for condition, body in statement.branches:
+                names |= self.get_assigned(body)
+        return names
+
+    def function_to_ast(self, statement):
+        instruction = statement.instruction
+        body = self.get_prologue(statement.scope, statement.token)
+        body += self.body_to_ast(statement.body)
+        if statement.type == "function":
+            # the function name is its result outside of calls: a local _result, so recursive calls still reach the function
+            calls = set(id(node.func) for node in ast.walk(ast.Module(body, [])) if isinstance(node, ast.Call))
+            for node in ast.walk(ast.Module(body, [])):
+                if isinstance(node, ast.Name) and node.id == instruction.name and not id(node) in calls:
+                    node.id = "_result"
+            body.append(self.located(ast.Return(ast.Name("_result", ast.Load())), statement.token))
+        arguments = ast.arguments([], [ ast.arg(name) for name, modifier in instruction.args ], None, [], [], None, [])
+        return self.located(ast.FunctionDef(instruction.name, arguments, body, [], None), statement.token)
+
+    def iter_statements(self, statements):
+        for statement in statements:
+            yield statement
+            yield from self.iter_statements(statement.body)
+            for condition, body in statement.branches:
+                yield from self.iter_statements(body)
+
+    def body_to_ast(self, statements):
+        body = []
+        for statement in statements:
+            body.extend(self.statement_to_ast(statement))
+        return body if len(body) > 0 else [ ast.Pass() ]
+
+    def statement_to_ast(self, statement):
+        token = statement.token
+        if statement.type == "print":
+            write = ast.Attribute(ast.Name("response", ast.Load()), "write", ast.Load())
+            return [ self.located(ast.Expr(ast.Call(write, [ statement.value ], [])), token) ]
+        if statement.type == "assign" or statement.type == "dim":
+            return [ self.located(ast.Assign([ statement.target ], statement.value), token) ]
+        if statement.type == "call":
+            return [ self.located(ast.Expr(statement.value), token) ]
+        if statement.type == "if":
+            orelse = []
+            for condition, body in reversed(statement.branches):
+                if condition is None:
+                    orelse = self.body_to_ast(body)
+                else:
+                    orelse = [ ast.copy_location(ast.If(condition, self.body_to_ast(body), orelse), condition) ]
+            return orelse
+        if statement.type == "for each":
+            return [ self.located(ast.For(statement.target, statement.value, self.body_to_ast(statement.body), []), token) ]
+        if statement.type == "for":
+            # inclusive stop: range(start, stop + 1, step), or stop - 1 for a negative step
+            start, stop = statement.range[:2]
+            step = statement.range[2] if len(statement.range) == 3 else None
+            negative = (isinstance(step, ast.Constant) and step.value < 0) or (isinstance(step, ast.UnaryOp) and isinstance(step.op, ast.USub))
+            stop = ast.BinOp(stop, ast.Sub() if negative else ast.Add(), ast.Constant(1))
+            loop_range = ast.Call(ast.Name("_range", ast.Load()), [ start, stop ] + ([ step ] if step else []), [])
+            return [ self.located(ast.For(statement.target, loop_range, self.body_to_ast(statement.body), []), token) ]
+        if statement.type == "do while":
+            return [ self.located(ast.While(statement.value, self.body_to_ast(statement.body), []), token) ]
+        if statement.type == "break":
+            return [ self.located(ast.Break(), token) ]
+        if statement.type == "return":
+            return [ self.located(ast.Return(statement.value), token) ]
+        return []
+
+    def located(self, node, token):
+        node.lineno = node.end_lineno = token.line
+        node.col_offset = token.column - 1
+        node.end_col_offset = node.col_offset + len(token.name)
+        return node
+
+    def set_error(self, token, errormessage):
+        file, line = get_source_line(self.lines, token.line)
+        file = file or self.path
+        self.errors.append(f"{file + ': ' if file else ''}Line {line}, column {token.column}, token '{token.name}': " + errormessage)
+
+class ResponseEnd(Exception):
+    pass
+
+class Response():
+    """Response object of the transpiled pages. The output is buffered as a list of strings joined once; with a writer
+    (callable receiving bytes: WSGI write, ASGI send wrapper...) it is sent in chunks of about flush_size characters,
+    and at each write when buffer is false."""
+    def __init__(self, writer = None, buffer = True, flush_size = 64 * 1024):
+        self.parts = []
+        self.size = 0 # characters buffered
+        self.writer = writer
+        self.buffer = buffer
+        self.flush_size = flush_size
+        self.status = "200 OK"
+        self.contenttype = "text/html"
+        self.charset = "utf-8"
+
+    def write(self, value):
+        text = f"{value}"
+        self.parts.append(text)
+        self.size += len(text)
+        if self.writer and (self.size >= self.flush_size or not self.buffer):
+            self.flush()
+
+    def flush(self):
+        if self.writer and self.size > 0:
+            data = "".join(self.parts).encode(self.charset)
+            self.parts = []
+            self.size = 0
+            self.writer(data)
+
+    def clear(self):
+        self.parts = []
+        self.size = 0
+
+    def end(self):
+        raise ResponseEnd() # stops the page, run_page flushes the output
+
+    def get_value(self):
+        """Output not sent to the writer yet, all the output without writer."""
+        return "".join(self.parts)
+
+    def get_headers(self):
+        return [ ("Content-Type", f"{self.contenttype}; charset={self.charset}") ]
+
 def load_file(file_name):
-    with open(os.path.join(str(Path(__file__).parent), file_name), 'r') as file:
+    with open_file(file_name) as file:
         return file.readlines()
 
-if __name__ == "__main__":
+def open_file(file_name):
+    return open(os.path.join(str(Path(__file__).parent), file_name), 'r')
+
+lexers = { "char": Lexer, "regex": RegexLexer }
+include_cache = {} # include files lexed by this process, shared by all the files it converts
+page_cache = {} # page path => (code, [ (path, (mtime, size)) ] of the page and its includes, lines of the includes, includes), pages loaded by this process
+
+def find_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for folder, folders, names in os.walk(path):
+                folders.sort()
+                files.extend(os.path.join(folder, name) for name in sorted(names) if name.lower().endswith(".asp"))
+        else:
+            files.extend(sorted(glob.glob(path, recursive = True)))
+    return list(dict.fromkeys(os.path.normpath(file) for file in files))
+
+def convert_file(path, root = ".", lexer_class = Lexer, cache_folder = None, stats = False, max_errors = 1):
+    stats = Stats(path) if stats else None
+    started = stats.start() if stats else None
+    disk_cache = DiskCache(cache_folder) if cache_folder else None
+    resolver = IncludeResolver(root, lexer_class, include_cache, disk_cache, stats)
+    tokens = list(resolver.iter_rows(path))
+    parser = Parser(stats = stats, max_errors = max_errors, row_paths = resolver.row_paths)
+    if len(resolver.errors) == 0:
+        digest = hashlib.sha256(" ".join(resolver.digests + resolver.paths + [ str(max_errors) ]).encode()).hexdigest()
+        data = disk_cache.get("parse", digest) if disk_cache else None
+        if data:
+            DiskCache.load_parser(parser, data, tokens)
+        else:
+            parser.parse(tokens)
+            if disk_cache:
+                disk_cache.set("parse", digest, DiskCache.dump_parser(parser, tokens))
+    if stats:
+        stats.stop("file", started)
+    return path, resolver.errors, parser.errors, stats
+
+def convert_files(files, root = ".", lexer_class = Lexer, jobs = None, chunksize = 16, cache_folder = None, stats = False, max_errors = 1):
+    if jobs == 1:
+        return [ convert_file(file, root, lexer_class, cache_folder, stats, max_errors) for file in files ]
+    with concurrent.futures.ProcessPoolExecutor(max_workers = jobs) as executor:
+        return list(executor.map(convert_file, files, itertools.repeat(root), itertools.repeat(lexer_class), itertools.repeat(cache_folder),
+                                 itertools.repeat(stats), itertools.repeat(max_errors), chunksize = chunksize))
+
+def file_digest(path):
+    with open(path, 'r') as file:
+        return hashlib.sha256(file.read().encode()).hexdigest()
+
+def get_stamp(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+def load_page(path, root = ".", lexer_class = Lexer, cache_folder = None, stats = None, max_errors = 1, includes = None):
+    """Code object of a page and its errors. The code is kept in memory while the page and its includes keep their
+    mtime and size, and on disk while they keep their content, so serving a page again needs no parsing or compiling.
+    Statements from include files are compiled after the last line of the page, run_page maps them back.
+    includes, when given, receives the paths included by the page and by each file it includes."""
+    path = os.path.normpath(path)
+    cached = page_cache.get(path)
+    try:
+        if cached and all(get_stamp(file) == stamp for file, stamp in cached[1]):
+            if includes is not None:
+                includes.update(cached[3])
+            return cached[0], []
+    except OSError:
+        pass
+
+    disk_cache = DiskCache(cache_folder) if cache_folder else None
+    key = hashlib.sha256(f"{os.path.abspath(path)} {os.path.abspath(root)} {file_digest(path)}".encode()).hexdigest()
+    data = disk_cache.get("code", key) if disk_cache else None
+    try:
+        if not data or any(file_digest(file) != digest for file, digest in data[0]):
+            data = None
+    except OSError:
+        data = None
+    if data:
+        files, code, lines, graph = [ file for file, digest in data[0] ], data[1], data[2], data[3]
+    else:
+        resolver = IncludeResolver(root, lexer_class, include_cache, disk_cache, stats)
+        tokens = list(resolver.iter_rows(path))
+        graph = { file: resolver.includes.get(file, []) for file in [ path ] + resolver.paths }
+        if includes is not None:
+            includes.update(graph)
+        if len(resolver.errors) > 0:
+            return None, resolver.errors
+        parser = Parser(stats = stats, max_errors = max_errors, row_paths = resolver.row_paths)
+        parser.parse(tokens)
+        tokens, lines = map_include_lines(path, tokens, resolver.row_paths)
+        transpiler = Transpiler(stats, lines = lines, path = path)
+        code = None if len(parser.errors) > 0 else transpiler.transpile(tokens, path)
+        if code is None:
+            return None, parser.errors + transpiler.errors
+        dependencies = list(dict.fromkeys(zip(resolver.paths, resolver.digests)))
+        files = [ file for file, digest in dependencies ]
+        if disk_cache:
+            disk_cache.set("code", key, (dependencies, code, lines, graph))
+    if includes is not None:
+        includes.update(graph)
+    page_cache[path] = (code, [ (file, get_stamp(file)) for file in files ], lines, graph)
+    return code, []
+
+def map_include_lines(path, rows, row_paths):
+    """Rows of a page with the rows of its include files moved after the last line of the page, so that each line of
+    the code comes from a single file, and the table of the moved lines: [ (first line, include path, line offset) ]."""
+    last = max((token.line for row, file in zip(rows, row_paths) if file == path for token in row), default = 0)
+    mapped = []
+    lines = []
+    run_file = None # include file of the previous row
+    for row, file in zip(rows, row_paths):
+        if file == path:
+            run_file = None
+        elif len(row) > 0:
+            if file != run_file:
+                run_file = file
+                lines.append((last + 1, file, row[0].line - last - 1))
+            offset = lines[-1][2]
+            row = [ Token(t.name, t.type, t.value, t.line - offset - 1, t.column - 1) for t in row ]
+            last = max(last, row[-1].line)
+        mapped.append(row)
+    return mapped, lines
+
+def get_source_line(lines, line):
+    """Include file (None for the page) and line in that file of a line of the code of a page."""
+    i = bisect.bisect_right(lines, (line, "\uffff")) - 1
+    if i < 0:
+        return None, line
+    return lines[i][1], line + lines[i][2]
+
+def run_page(code, response, **objects):
+    """Execute the code of a page and flush its output, objects are the other ASP objects (request, server, session, application)."""
+    try:
+        exec(code, dict(objects, response = response, empty = empty, _range = range))
+    except ResponseEnd:
+        pass
+    except Exception as error:
+        cached = page_cache.get(code.co_filename)
+        if cached and cached[0] is code:
+            set_source_traceback(error, code.co_filename, cached[2])
+        raise
+    response.flush()
+
+def set_source_traceback(error, path, lines):
+    """(file, line) of the .asp source of each frame of the page in the error traceback, in error.source_traceback and
+    in a note of the error."""
+    error.source_traceback = []
+    traceback = error.__traceback__
+    while traceback:
+        if traceback.tb_frame.f_code.co_filename == path:
+            file, line = get_source_line(lines, traceback.tb_lineno)
+            error.source_traceback.append((file or path, line))
+        traceback = traceback.tb_next
+    if hasattr(error, "add_note"):
+        error.add_note("ASP source:\n" + "\n".join(f'  File "{file}", line {line}' for file, line in error.source_traceback))
+
+def page_application(root, cache_folder = None, flush_size = 64 * 1024):
+    """WSGI application serving the pages of root, the headers are sent with the first chunk of output."""
+    root = os.path.abspath(root)
+
+    def application(environ, start_response):
+        path = os.path.normpath(os.path.join(root, environ.get("PATH_INFO", "/").lstrip("/")))
+        if not path.startswith(root + os.sep) or not os.path.isfile(path):
+            start_response("404 Not Found", [ ("Content-Type", "text/plain") ])
+            return [ b"Not found" ]
+        code, errors = load_page(path, root, cache_folder = cache_folder)
+        if code is None:
+            start_response("500 Internal Server Error", [ ("Content-Type", "text/plain") ])
+            return [ "\n".join(errors).encode() ]
+
+        write = None
+        def writer(data):
+            nonlocal write
+            if write is None:
+                write = start_response(response.status, response.get_headers())
+            write(data)
+        response = Response(writer, flush_size = flush_size)
+        run_page(code, response)
+        if write is None: # no output
+            start_response(response.status, response.get_headers())
+        return []
+
+    return application
+
+class Watcher():
+    """Pages of a tree kept built: the page files and the files they include are polled for mtime or size changes,
+    and only the changed pages and the pages including a changed file, directly or not, are built again."""
+    def __init__(self, paths, root = ".", lexer_class = Lexer, cache_folder = None, max_errors = 1):
+        self.paths = paths
+        self.root = root
+        self.lexer_class = lexer_class
+        self.cache_folder = cache_folder
+        self.max_errors = max_errors
+        self.pages = []
+        self.stamps = {} # watched path => (mtime, size), None when missing
+        self.includes = {} # path => paths it includes
+        self.included_by = {} # path => paths including it
+
+    def build(self, path):
+        """Lex, parse and transpile a page with load_page, its code goes to page_cache (and to the disk cache).
+        Returns its errors, a page failing to build is no longer in page_cache."""
+        page_cache.pop(path, None)
+        includes = {}
+        code, errors = load_page(path, self.root, self.lexer_class, self.cache_folder, max_errors = self.max_errors, includes = includes)
+        for file, included in includes.items():
+            self.set_includes(file, included)
+            for include in included:
+                if not include in self.stamps: # found by this build, changes from now on
+                    self.stamps[include] = self.get_stamp(include)
+        return errors
+
+    def set_includes(self, path, includes):
+        for include in self.includes.get(path, []):
+            self.included_by[include].discard(path)
+        self.includes[path] = set(includes)
+        for include in includes:
+            self.included_by.setdefault(include, set()).add(path)
+
+    def poll(self):
+        """Paths created, changed or removed since the previous poll."""
+        self.pages = find_files(self.paths)
+        changed = set()
+        for path in set(self.pages) | set(self.stamps):
+            stamp = self.get_stamp(path)
+            if self.stamps.get(path, False) != stamp:
+                changed.add(path)
+            self.stamps[path] = stamp
+        return changed
+
+    def get_stamp(self, path):
+        try:
+            return get_stamp(path)
+        except OSError:
+            return None
+
+    def get_affected(self, changed):
+        """Pages to build for the changed paths: themselves and their includers, following the include graph up."""
+        affected = set()
+        pending = list(changed)
+        while len(pending) > 0:
+            path = pending.pop()
+            if not path in affected:
+                affected.add(path)
+                pending.extend(self.included_by.get(path, []))
+        return [ page for page in self.pages if page in affected ]
+
+    def rebuild(self, changed):
+        results = {}
+        for path in changed:
+            if self.stamps.get(path) is None: # removed
+                page_cache.pop(path, None)
+                if not path in self.included_by or len(self.included_by[path]) == 0:
+                    self.set_includes(path, [])
+                    self.stamps.pop(path, None)
+        for page in self.get_affected(changed):
+            results[page] = self.build(page)
+        return results
+
+    def run(self, report, interval = 0.5, delay = 0.2):
+        """Poll every interval seconds, wait until a burst of saves is over (no change for delay seconds), build, then
+        call report with { page: errors }. Never returns."""
+        report(self.rebuild(self.poll()))
+        while True:
+            time.sleep(interval)
+            changed = self.poll()
+            if len(changed) == 0:
+                continue
+            while True:
+                time.sleep(delay)
+                more = self.poll()
+                if len(more) == 0:
+                    break
+                changed |= more
+            report(self.rebuild(changed))
+
+def watch(args):
+    def report(results):
+        for page, errors in results.items():
+            for err in errors:
+                print(err, file=sys.stderr)
+        failed = sum(1 for errors in results.values() if len(errors) > 0)
+        print(f"{time.strftime('%H:%M:%S')} {len(results)} file(s) built, {failed} with errors", flush = True)
+
+    watcher = Watcher(args.paths, args.root, lexers[args.lexer], args.cache, args.max_errors)
+    try:
+        watcher.run(report, args.interval)
+    except KeyboardInterrupt:
+        return 0
+
+def lex_source(path, text = None, lexer_class = Lexer):
+    """Token rows, as [ type, name, value, line, column ] lists, and errors of a file, or of text (an unsaved buffer)."""
+    lexer = lexer_class()
+    if text is None:
+        with open(path, 'r') as file:
+            lexer.lex(file)
+    else:
+        lexer.lex(text.splitlines(True))
+    rows = [ [ [ token.type, token.name, token.value, token.line, token.column ] for token in tokens_row ] for tokens_row in lexer.source_tokens ]
+    return rows, [ f"{path}: {err}" for err in lexer.errors ]
+
+def parse_source(path, text = None, lexer_class = Lexer, max_errors = 1):
+    """Errors, definitions and references (see SymbolIndex.get_symbols) of a file, or of text, without its includes."""
+    lexer = lexer_class()
+    if text is None:
+        with open(path, 'r') as file:
+            lexer.lex(file)
+    else:
+        lexer.lex(text.splitlines(True))
+    parser = Parser(max_errors = max_errors)
+    if len(lexer.errors) == 0:
+        parser.parse(lexer.source_tokens)
+    definitions, references = SymbolIndex.get_symbols(parser.identified)
+    return [ f"{path}: {err}" for err in lexer.errors + parser.errors ], definitions, references
+
+class Daemon():
+    """Resident server answering JSON-RPC 2.0 requests, one JSON object per line, on stdio or on a Unix socket.
+    The lexer and parser tables are built once, the results of unchanged files are kept, the worker processes keep
+    their include_cache between requests and every parsed file updates the symbol index.
+    Requests of a client run concurrently, their responses are written as they complete."""
+    param_types = { "path": str, "text": (str, type(None)), "name": str, "line": int, "column": int }
+    def __init__(self, root = ".", lexer_class = Lexer, jobs = None, cache_folder = None, max_errors = 1):
+        self.root = root
+        self.lexer_class = lexer_class
+        self.cache_folder = cache_folder
+        self.max_errors = max_errors
+        self.executor = None if jobs == 1 else concurrent.futures.ProcessPoolExecutor(max_workers = jobs)
+        self.index = SymbolIndex()
+        self.results = {} # (method, path) => ((mtime, size), result) of the files lexed or parsed
+        self.stopped = None
+        self.pending = set() # requests being answered, of every client
+        self.methods = {
+            "lex": self.lex,
+            "parse": self.parse,
+            "diagnostics": self.diagnostics,
+            "index": self.index_files,
+            "definitions": self.definitions,
+            "references": self.references,
+            "symbol_at": self.symbol_at,
+            "shutdown": self.shutdown,
+        }
+
+    async def run_worker(self, function, *args):
+        if self.executor is None:
+            return function(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def run_cached(self, method, path, function, *args):
+        stamp = get_stamp(path)
+        cached = self.results.get((method, path))
+        if cached and cached[0] == stamp:
+            return cached[1]
+        result = await self.run_worker(function, path, None, *args)
+        self.results[(method, path)] = (stamp, result)
+        return result
+
+    async def lex(self, path, text = None):
+        path = os.path.normpath(path)
+        if text is None:
+            rows, errors = await self.run_cached("lex", path, lex_source, self.lexer_class)
+        else:
+            rows, errors = await self.run_worker(lex_source, path, text, self.lexer_class)
+        return { "tokens": rows, "errors": errors }
+
+    async def parse(self, path, text = None):
+        """Errors and symbols of a file (its includes are not expanded), the symbol index is updated with them."""
+        path = os.path.normpath(path)
+        if text is None:
+            errors, definitions, references = await self.run_cached("parse", path, parse_source, self.lexer_class, self.max_errors)
+        else:
+            errors, definitions, references = await self.run_worker(parse_source, path, text, self.lexer_class, self.max_errors)
+        self.index.remove_file(path)
+        self.index.add_file(path, definitions, references)
+        return {
+            "errors": errors,
+            "definitions": [ { "name": name, "type": type, "line": line, "column": column } for name, type, line, column in definitions ],
+            "references": [ { "name": name, "line": line, "column": column } for name, type, line, column in references ],
+        }
+
+    async def diagnostics(self, path, text = None):
+        """Errors of a page with its includes expanded (as the batch mode reports them), or of text without includes."""
+        path = os.path.normpath(path)
+        if text is None:
+            path, lexer_errors, parser_errors, stats = await self.run_worker(convert_file, path, self.root, self.lexer_class, self.cache_folder, False, self.max_errors)
+            return { "errors": lexer_errors + parser_errors }
+        errors, definitions, references = await self.run_worker(parse_source, path, text, self.lexer_class, self.max_errors)
+        return { "errors": errors }
+
+    async def index_files(self, paths):
+        """Parse the files, directories or glob patterns in parallel for the symbol index."""
+        files = find_files(paths)
+        results = await asyncio.gather(*[ self.parse(file) for file in files ])
+        return { "files": len(files), "errors": [ err for result in results for err in result["errors"] ] }
+
+    async def definitions(self, name):
+        return [ { "path": path, "type": type, "line": line, "column": column } for path, type, line, column in self.index.find_definitions(name) ]
+
+    async def references(self, name):
+        return [ { "path": path, "line": line, "column": column } for path, line, column in self.index.find_references(name) ]
+
+    async def symbol_at(self, path, line, column):
+        symbol = self.index.find_at(os.path.normpath(path), line, column)
+        return None if symbol is None else { "name": symbol[0], "type": symbol[1] }
+
+    async def shutdown(self):
+        asyncio.get_running_loop().call_soon(self.stopped.set) # once the response is sent
+        return None
+
+    async def handle(self, line):
+        """Response to a request line, None for a notification (no id)."""
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return Daemon.get_error(None, -32700, "Parse error")
+        if not isinstance(request, dict) or not isinstance(request.get("method"), str):
+            return Daemon.get_error(request.get("id") if isinstance(request, dict) else None, -32600, "Invalid Request")
+        id = request.get("id")
+        method = self.methods.get(request["method"])
+        params = request.get("params", {})
+        if method is None:
+            response = Daemon.get_error(id, -32601, f"Method not found: {request['method']}")
+        else:
+            try:
+                arguments = inspect.signature(method).bind(*params) if isinstance(params, list) else inspect.signature(method).bind(**params)
+                for name, value in arguments.arguments.items():
+                    if not Daemon.is_valid_param(name, value):
+                        raise TypeError(f"wrong type for '{name}'")
+            except TypeError as error:
+                response = Daemon.get_error(id, -32602, f"Invalid params: {error}")
+            else:
+                try:
+                    response = { "jsonrpc": "2.0", "id": id, "result": await method(*arguments.args, **arguments.kwargs) }
+                except (OSError, ValueError) as error:
+                    response = Daemon.get_error(id, -32000, str(error))
+                except Exception as error: # a client waiting for the response must get one
+                    response = Daemon.get_error(id, -32603, f"Internal error: {type(error).__name__}: {error}")
+        return response if "id" in request else None
+
+    @staticmethod
+    def is_valid_param(name, value):
+        if name == "paths":
+            return isinstance(value, list) and all(isinstance(path, str) for path in value)
+        return isinstance(value, Daemon.param_types[name])
+
+    @staticmethod
+    def get_error(id, code, message):
+        return { "jsonrpc": "2.0", "id": id, "error": { "code": code, "message": message } }
+
+    async def serve_stream(self, reader, send):
+        """Answer the request lines of reader until its end, send(bytes) writes a response line."""
+
+        async def answer(line):
+            response = await self.handle(line)
+            if response is not None:
+                await send(json.dumps(response).encode() + b"\n")
+
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if line.strip():
+                task = asyncio.ensure_future(answer(line))
+                self.pending.add(task)
+                task.add_done_callback(self.pending.discard)
+        await self.finish()
+
+    async def finish(self):
+        if len(self.pending) > 0:
+            await asyncio.gather(*self.pending)
+
+    async def serve_client(self, reader, writer):
+        async def send(data):
+            writer.write(data)
+            await writer.drain()
+
+        try:
+            await self.serve_stream(reader, send)
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path = None):
+        """Serve stdio, or the clients of a Unix socket, until a shutdown request or the end of stdin.
+        The requests received before the shutdown are answered."""
+        self.stopped = asyncio.Event()
+        try:
+            if socket_path:
+                server = await asyncio.start_unix_server(self.serve_client, socket_path)
+                try:
+                    await self.stopped.wait()
+                    await self.finish()
+                finally:
+                    server.close()
+                    if os.path.exists(socket_path):
+                        os.remove(socket_path)
+            else:
+                async def send(data):
+                    sys.stdout.buffer.write(data)
+                    sys.stdout.buffer.flush()
+
+                reader = asyncio.StreamReader()
+                await asyncio.get_running_loop().connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+                serving = asyncio.ensure_future(self.serve_stream(reader, send))
+                stopping = asyncio.ensure_future(self.stopped.wait())
+                await asyncio.wait([ serving, stopping ], return_when = asyncio.FIRST_COMPLETED)
+                await self.finish()
+                for task in [ serving, stopping ]:
+                    task.cancel()
+        finally:
+            if self.executor:
+                self.executor.shutdown(cancel_futures = True)
+
+def serve(args):
+    daemon = Daemon(args.root, lexers[args.lexer], args.jobs, args.cache, args.max_errors)
+    try:
+        asyncio.run(daemon.serve(args.socket))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+def batch(args):
+    files = find_files(args.paths)
+    results = convert_files(files, args.root, lexers[args.lexer], 1 if args.profile else args.jobs, args.chunksize, args.cache, args.stats, args.max_errors)
+    if args.cache:
+        DiskCache(args.cache, args.cache_max_size * 1024 * 1024, args.cache_max_age * 24 * 3600).evict()
+    failed = 0
+    total = Stats("total")
+    for path, lexer_errors, parser_errors, stats in results:
+        if len(lexer_errors) + len(parser_errors) > 0:
+            failed += 1
+        for err in lexer_errors + parser_errors:
+            print(err, file=sys.stderr)
+        if stats:
+            total.merge(stats)
+    print(f"{len(files)} file(s) converted, {failed} with errors")
+    if args.stats:
+        print("")
+        total.print()
+    return 1 if failed > 0 else 0
+
+def get_arguments(argv = None):
+    arguments = argparse.ArgumentParser(description = "Convert ASP VbScript pages.")
+    arguments.add_argument("paths", nargs = "*", help = "files, directories or glob patterns to convert (default: source.asp sample)")
+    arguments.add_argument("-j", "--jobs", type = int, default = None, help = "number of worker processes (default: number of CPUs)")
+    arguments.add_argument("--chunksize", type = int, default = 16, help = "number of files sent to a worker at once")
+    arguments.add_argument("--root", default = ".", help = "site root used to resolve '#include virtual' paths")
+    arguments.add_argument("--cache", default = None, help = "folder of the on-disk cache of lexing and parsing results (default: no cache)")
+    arguments.add_argument("--cache-max-size", type = int, default = 512, help = "cache size limit in MB, oldest entries are evicted first")
+    arguments.add_argument("--cache-max-age", type = int, default = 30, help = "entries unused for more days are evicted")
+    arguments.add_argument("--lexer", choices = lexers.keys(), default = "char", help = "lexer engine")
+    arguments.add_argument("--watch", action = "store_true", help = "keep running, build again the pages changed and the pages including a changed file")
+    arguments.add_argument("--interval", type = float, default = 0.5, help = "seconds between two polls of the watched files")
+    arguments.add_argument("--daemon", action = "store_true", help = "keep running, answer JSON-RPC requests (lex, parse, diagnostics, symbols) on stdio")
+    arguments.add_argument("--socket", default = None, help = "with --daemon, answer the clients of this Unix socket instead of stdio")
+    arguments.add_argument("--max-errors", type = int, default = 1, help = "parser errors reported per file, the parser recovers after each one until this count")
+    arguments.add_argument("--stats", action = "store_true", help = "print the time and allocated blocks of each phase, token counts, hottest branch paths and slowest files")
+    arguments.add_argument("--profile", action = "store_true", help = "run in a single process under cProfile and print the most expensive functions")
+    return arguments.parse_args(argv)
+
+def main(args):
+    if args.daemon:
+        return serve(args)
+    if args.watch:
+        return watch(args)
+    if len(args.paths) > 0:
+        return batch(args)
+
+    stats = Stats("source.asp") if args.stats else None
     source = load_file("source.asp")
-    lexer = Lexer()
+    lexer = lexers[args.lexer](stats = stats)
     lexer.lex(source)
     #lexer.print()
     lexer.print_errors()
 
     if len(lexer.errors) == 0:
-        parser = Parser()
+        parser = Parser(stats = stats, max_errors = args.max_errors)
         parser.parse(lexer.source_tokens)
         parser.print_errors()
 
@@ -470,3 +2827,16 @@ if __name__ == "__main__":
                 print(instruction_type)
                 for instruction in instruction_list:
                     print(f"    {instruction.line}: {instruction.name}" + "" if instruction.value is None else f"={instruction.value}")
+    if stats:
+        print("")
+        stats.print()
+    return 0
+
+if __name__ == "__main__":
+    args = get_arguments()
+    if args.profile:
+        profile = cProfile.Profile()
+        result = profile.runcall(main, args)
+        pstats.Stats(profile, stream = sys.stderr).sort_stats("cumulative").print_stats(25)
+        sys.exit(result)
+    sys.exit(main(args))
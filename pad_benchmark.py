@@ -0,0 +1,192 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+import pad
+
+scenarios = {
+    "small": dict(lines = 200, depth = 2, html_ratio = 0.2, string_density = 0.5, includes = 0),
+    "large": dict(lines = 20000, depth = 3, html_ratio = 0.2, string_density = 0.5, includes = 0),
+    "deep": dict(lines = 5000, depth = 12, html_ratio = 0.05, string_density = 0.3, includes = 0),
+    "html": dict(lines = 5000, depth = 2, html_ratio = 0.7, string_density = 0.3, includes = 0),
+    "strings": dict(lines = 5000, depth = 2, html_ratio = 0.1, string_density = 0.9, includes = 0),
+    "includes": dict(lines = 2000, depth = 3, html_ratio = 0.2, string_density = 0.5, includes = 8),
+}
+
+def generate_page(lines = 1000, depth = 3, html_ratio = 0.2, string_density = 0.5, includes = 0, seed = 0):
+    """Synthetic ASP page of about `lines` lines, valid for the lexer and the parser.
+    depth: maximum if/for each/do while nesting, html_ratio: share of HTML lines,
+    string_density: share of values that are string literals, includes: number of '#include file' lines."""
+    rand = random.Random(seed)
+    source = [ f'<!-- #include file="include_{n}.asp" -->\n' for n in range(includes) ]
+    source.append("<%\n")
+    blocks = [] # open blocks: [ keyword, else seen ]
+    functions = 0
+
+    def value():
+        if rand.random() < string_density:
+            text = " ".join(rand.choice([ "some", "text", "\"\"quoted\"\"", "value", "<b>html</b>" ]) for _ in range(rand.randint(1, 6)))
+            return f'"{text}"' if rand.random() < 0.7 else f'"{text}" & name{rand.randint(0, 9)} & "!"'
+        return f"{rand.randint(0, 1000)} + count{rand.randint(0, 9)} * {rand.randint(1, 9)}"
+
+    while len(source) < lines:
+        indent = "    " * len(blocks)
+        r = rand.random()
+        if r < html_ratio:
+            source.append("%>\n")
+            for _ in range(rand.randint(1, 8)):
+                source.append(f'{indent}<div class="row{rand.randint(0, 9)}">Some static text {rand.randint(0, 99999)}</div>\n')
+            source.append("<%\n")
+        elif r < html_ratio + 0.08 and len(blocks) < depth:
+            keyword = rand.choice([ "if", "if", "for each", "do while" ])
+            if keyword == "if":
+                source.append(f"{indent}if count{rand.randint(0, 9)} >= {rand.randint(0, 100)} then\n")
+            elif keyword == "for each":
+                source.append(f"{indent}for each item{len(blocks)} in list{rand.randint(0, 9)}\n")
+            else:
+                source.append(f"{indent}do while count{rand.randint(0, 9)} < {rand.randint(0, 100)}\n")
+            blocks.append([ keyword, False ])
+        elif r < html_ratio + 0.12 and len(blocks) > 0 and blocks[-1][0] == "if" and not blocks[-1][1]:
+            indent = "    " * (len(blocks) - 1)
+            if rand.random() < 0.5:
+                source.append(f"{indent}elseif count{rand.randint(0, 9)} = {rand.randint(0, 100)} then\n")
+            else:
+                source.append(f"{indent}else\n")
+                blocks[-1][1] = True
+        elif r < html_ratio + 0.18 and len(blocks) > 0:
+            source.append(close_block(blocks))
+        elif r < html_ratio + 0.2 and len(blocks) == 0:
+            source.append(f"function some_function{functions}(byval first, byref second, third)\n")
+            blocks.append([ "function", False ])
+            functions += 1
+        elif r < html_ratio + 0.5:
+            source.append(f"{indent}Response.Write({value()})\n")
+        else:
+            source.append(f"{indent}name{rand.randint(0, 9)} = {value()} ' comment\n")
+    while len(blocks) > 0:
+        source.append(close_block(blocks))
+    source.append("%>\n")
+    return source
+
+def close_block(blocks):
+    keyword = blocks.pop()[0]
+    indent = "    " * len(blocks)
+    return indent + { "if": "end if", "for each": "next", "do while": "loop", "function": "end function" }[keyword] + "\n"
+
+def write_site(folder, lines = 1000, depth = 3, html_ratio = 0.2, string_density = 0.5, includes = 0, seed = 0):
+    """Write the page and its include files in folder, return the page path."""
+    for n in range(includes):
+        with open(os.path.join(folder, f"include_{n}.asp"), 'w') as file:
+            file.writelines(generate_page(max(lines // 10, 20), depth, html_ratio, string_density, 0, seed + n + 1))
+    path = os.path.join(folder, "page.asp")
+    with open(path, 'w') as file:
+        file.writelines(generate_page(lines, depth, html_ratio, string_density, includes, seed))
+    return path
+
+def measure(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def lex(lexer_class, source):
+    lexer = lexer_class()
+    lexer.lex(source)
+    return lexer
+
+def parse(rows):
+    parser = pad.Parser()
+    parser.parse(rows)
+    return parser
+
+def resolve(lexer_class, path):
+    resolver = pad.IncludeResolver(os.path.dirname(path), lexer_class)
+    return list(resolver.iter_rows(path))
+
+def run_scenario(parameters, lexer_class = pad.Lexer, repeat = 5, seed = 0):
+    with tempfile.TemporaryDirectory() as folder:
+        path = write_site(folder, seed = seed, **parameters)
+        with open(path, 'r') as file:
+            source = file.readlines()
+
+        lex_time, lexer = measure(lambda: lex(lexer_class, source), repeat)
+        tokens = sum(len(row) for row in lexer.source_tokens)
+        parse_time, parser = measure(lambda: parse(lexer.source_tokens), repeat)
+        include_time, rows = measure(lambda: resolve(lexer_class, path), repeat)
+        if len(lexer.errors) + len(parser.errors) > 0:
+            raise ValueError(f"generated page has errors: {(lexer.errors + parser.errors)[:3]}")
+
+        tracemalloc.start()
+        parse(lex(lexer_class, source).source_tokens)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    def phase(seconds):
+        return { "seconds": seconds, "tokens_per_second": tokens / seconds, "lines_per_second": len(source) / seconds }
+
+    return {
+        "parameters": parameters,
+        "lines": len(source),
+        "tokens": tokens,
+        "lex": phase(lex_time),
+        "parse": phase(parse_time),
+        "include": { "seconds": include_time, "rows": len(rows) },
+        "peak_memory": peak_memory,
+    }
+
+def compare(results, baseline, threshold):
+    """Print the time ratio of every phase against the baseline, return the regressions above threshold."""
+    regressions = []
+    for name, result in results.items():
+        if not name in baseline:
+            continue
+        for phase in [ "lex", "parse", "include" ]:
+            ratio = result[phase]["seconds"] / baseline[name][phase]["seconds"]
+            flag = ""
+            if ratio > 1 + threshold:
+                flag = " REGRESSION"
+                regressions.append((name, phase, ratio))
+            print(f"    {name:10} {phase:8} {ratio:6.2f}x{flag}")
+        ratio = result["peak_memory"] / baseline[name]["peak_memory"]
+        print(f"    {name:10} {'memory':8} {ratio:6.2f}x")
+    return regressions
+
+def get_arguments(argv = None):
+    arguments = argparse.ArgumentParser(description = "Benchmark the lexer and the parser on synthetic ASP pages.")
+    arguments.add_argument("-s", "--scenario", action = "append", choices = scenarios.keys(), help = "scenario to run (default: all)")
+    arguments.add_argument("--lexer", choices = pad.lexers.keys(), default = "char", help = "lexer engine")
+    arguments.add_argument("--repeat", type = int, default = 5, help = "runs per phase, the fastest is kept")
+    arguments.add_argument("--seed", type = int, default = 0, help = "seed of the page generator")
+    arguments.add_argument("--save", help = "write the results to this JSON file")
+    arguments.add_argument("--compare", help = "JSON results of a previous revision to compare with")
+    arguments.add_argument("--threshold", type = float, default = 0.1, help = "slowdown ratio reported as a regression")
+    return arguments.parse_args(argv)
+
+if __name__ == "__main__":
+    args = get_arguments()
+    results = {}
+    for name in args.scenario or scenarios.keys():
+        result = run_scenario(scenarios[name], pad.lexers[args.lexer], args.repeat, args.seed)
+        results[name] = result
+        print(f"{name:10} {result['lines']:7} lines {result['tokens']:8} tokens  "
+              f"lex {result['lex']['seconds'] * 1000:8.1f} ms ({result['lex']['tokens_per_second']:10.0f} tokens/s, {result['lex']['lines_per_second']:8.0f} lines/s)  "
+              f"parse {result['parse']['seconds'] * 1000:8.1f} ms ({result['parse']['tokens_per_second']:10.0f} tokens/s)  "
+              f"include {result['include']['seconds'] * 1000:8.1f} ms  "
+              f"peak {result['peak_memory'] / 1024 / 1024:6.1f} MB")
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump({ "python": sys.version, "lexer": args.lexer, "results": results }, file, indent = 4)
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            baseline = json.load(file)["results"]
+        print(f"\nCompared to {args.compare}:")
+        if len(compare(results, baseline, args.threshold)) > 0:
+            sys.exit(1)
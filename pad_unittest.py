@@ -1,28 +1,732 @@
 import unittest
 import os
+import sys
+import ast
+import tempfile
+import hashlib
+import json
+import io
+import contextlib
+import socket
+import asyncio
 from pathlib import Path
 import pad
+import pad_benchmark
 
 class AspBasicParserTests(unittest.TestCase):
 
     def test_ut_files(self):
+        for lexer_class in [pad.Lexer, pad.RegexLexer]:
+            for file, source, result in self.get_ut_files():
+                with self.subTest(file, lexer = lexer_class.__name__):
+                    lexer = lexer_class()
+                    lexer.lex(source)
+                    if len(lexer.errors) > 0:
+                        self.assertEqual(lexer.errors, result)
+                    else:
+                        parser = pad.Parser()
+                        parser.parse(lexer.source_tokens)
+                        self.assertEqual(parser.errors, result)
+
+    def test_regex_lexer_same_tokens(self):
+        sources = [ source for file, source, result in self.get_ut_files() ]
+        sources.append(pad.load_file("source.asp"))
+        sources.append([ "<p>\n", "<% x = \"a\"\"b\" REM comment\n", "y = 1 %>text<% z = 2.5 >= 1 ' c\n", "%>\n" ])
+        for source in sources:
+            with self.subTest(source[0]):
+                lexer = pad.Lexer()
+                lexer.lex(source)
+                regex_lexer = pad.RegexLexer()
+                regex_lexer.lex(source)
+                self.assertEqual(self.dump_tokens(regex_lexer.source_tokens), self.dump_tokens(lexer.source_tokens))
+                self.assertEqual(regex_lexer.errors, lexer.errors)
+
+    def test_streaming(self):
+        for file, source, result in self.get_ut_files():
+            with self.subTest(file):
+                lexer = pad.Lexer()
+                parser = pad.Parser()
+                parser.parse(lexer.iter_rows(iter(source)))
+                self.assertEqual(lexer.errors + parser.errors, result)
+
+        lexer = pad.Lexer()
+        lexer.lex(pad.load_file("source.asp"))
+        with pad.open_file("source.asp") as file:
+            tokens = list(pad.RegexLexer().iter_tokens(file))
+        self.assertEqual([ (t.type, t.name, t.line, t.column) for t in tokens ],
+                         [ (t.type, t.name, t.line, t.column) for row in lexer.source_tokens for t in row ])
+
+    def test_keywords(self):
+        source = [ "<%\n", "On Error  Resume Next\n", "on error goto 0\n", "exit do while x\n", "end end if(1) end\n", "on error resume x\n", "%>\n" ]
+        for lexer_class in [pad.Lexer, pad.RegexLexer]:
+            with self.subTest(lexer_class.__name__):
+                lexer = lexer_class()
+                lexer.lex(source)
+                self.assertEqual([ [ (t.type, t.name) for t in row if t.type in [ pad.Token.KEYWORD, pad.Token.IDENTIFIER ] ] for row in lexer.source_tokens[1:6] ], [
+                    [ ("K", "on error resume next") ],
+                    [ ("I", "on"), ("I", "error"), ("I", "goto") ],
+                    [ ("K", "exit do"), ("I", "while"), ("I", "x") ],
+                    [ ("K", "end"), ("K", "end if"), ("K", "end") ],
+                    [ ("I", "on"), ("I", "error"), ("I", "resume"), ("I", "x") ],
+                ])
+                self.assertEqual([ t.column for t in lexer.source_tokens[4] ], [ 1, 5, 11, 12, 13, 15 ])
+
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    lexer.print()
+                self.assertEqual(output.getvalue().splitlines()[1], "[K|on error resume next] ")
+
+    def test_instruction_rules(self):
+        source = [ "<%\n",
+                   "Sub Show(ByRef a, b)\n", "end sub\n",
+                   "dim x, arr(2, n), y\n",
+                   "set obj = Server.CreateObject(\"x\")\n",
+                   "call Response.Write(x)\n",
+                   "Response.Buffer = true\n",
+                   "for each item in arr\n", "next\n",
+                   "do while x < 3\n", "loop\n",
+                   "arr(i, f(y)) = 1 : Show (x), y\n",
+                   "%>\n" ]
+        lexer = pad.Lexer()
+        lexer.lex(source)
+        parser = pad.Parser()
+        parser.parse(lexer.source_tokens)
+        self.assertEqual(parser.errors, [])
+        instructions = { name: [ (i.line, i.name, i.args) for i in store ] for name, store in parser.identified.items() if name[0] != '#' }
+        self.assertEqual(instructions, {
+            "sub": [ (2, "show", [ ("a", "byref"), ("b", None) ]) ],
+            "dim": [ (4, "x", [ ("x", None), ("arr", None), ("y", None) ]) ],
+            "set": [ (5, "obj", []) ],
+            "call": [ (6, "response", []), (12, "show", []) ],
+            "assign": [ (7, "response", []), (12, "arr", []) ],
+            "for each": [ (8, "item", []) ],
+            "do while": [ (10, None, []) ],
+        })
+
+        rules = pad.Parser.instruction_rules
+        self.assertIs(rules.identify(lexer.source_tokens[1]), rules.rules["sub"])
+        self.assertIsNone(rules.identify(lexer.source_tokens[2]))
+
+        lexer = pad.Lexer()
+        lexer.lex([ "<% dim x(1 + 2) %>\n" ])
+        parser = pad.Parser()
+        parser.parse(lexer.source_tokens)
+        self.assertEqual(parser.errors, [ "Line 1, column 12, token '+': invalid syntax" ])
+
+    def test_compact_tokens(self):
+        lexer = pad.Lexer()
+        lexer.lex([ "<% Test = test + TEST %>\n", "<p>\n", "html<!-- #include file =\"include.asp\" -->text<% x %>\n" ])
+        tokens = [ t for row in lexer.source_tokens for t in row ]
+        self.assertFalse(hasattr(tokens[0], "__dict__"))
+        self.assertIs(tokens[0].name, tokens[2].name)
+        self.assertIs(tokens[0].name, tokens[4].name)
+        self.assertEqual([ t.value for t in tokens if t.type != pad.Token.IDENTIFIER and t.type != pad.Token.OPERATOR ],
+                         [ "\n<p>\nhtml", "include.asp", "text", "\n" ])
+
+    def test_include_resolver(self):
+        resolver = pad.IncludeResolver(cache = {})
+        rows = list(resolver.iter_rows(os.path.join(str(Path(__file__).parent), "source.asp")))
+        self.assertEqual(resolver.errors, [])
+        self.assertEqual(list(resolver.cache), [ os.path.join(str(Path(__file__).parent), "include.asp") ])
+        names = [ t.name for row in rows for t in row ]
+        self.assertEqual(names.count("writeline"), 2)
+        self.assertNotIn(pad.Token.PRINTINCFILE, [ t.type for row in rows for t in row ])
+
+    def test_include_resolver_paths_and_cycles(self):
+        with tempfile.TemporaryDirectory() as root:
+            os.mkdir(os.path.join(root, "inc"))
+            files = {
+                "page.asp": '<!-- #include file="inc/a.asp" --><!-- #include virtual="/inc/missing.asp" -->\n',
+                os.path.join("inc", "a.asp"): '<% a = 1 %><!-- #include virtual="/inc/b.asp" -->\n',
+                os.path.join("inc", "b.asp"): '<% b = 1 %><!-- #include file="a.asp" -->\n',
+            }
+            for name, content in files.items():
+                with open(os.path.join(root, name), 'w') as file:
+                    file.write(content)
+
+            cache = {}
+            resolver = pad.IncludeResolver(root, cache = cache)
+            page = os.path.join(root, "page.asp")
+            a = os.path.join(root, "inc", "a.asp")
+            b = os.path.join(root, "inc", "b.asp")
+            names = [ t.name for row in resolver.iter_rows(page) for t in row ]
+            self.assertEqual([ n for n in names if n in [ "a", "b" ] ], [ "a", "b" ])
+            self.assertEqual(resolver.errors, [
+                f"{b}: Line 1, column 12: Include cycle: {a} -> {b} -> {a}",
+                f"{page}: Line 1, column 35: Include file not found: /inc/missing.asp",
+            ])
+
+            rows = cache[a][3]
+            resolver = pad.IncludeResolver(root, cache = cache)
+            list(resolver.iter_rows(page))
+            self.assertIs(cache[a][3], rows)
+
+    def test_incremental_update(self):
+        source = pad.load_file("source.asp")
+        edits = [
+            (10, 11, [ "        test = \"abc9\"\n", "        x = 1\n" ]),
+            (3, 3, [ "%>\n", "<p>html</p>\n", "<%\n" ]),
+            (20, 22, []),
+            (5, 6, [ "if ord2 then then\n" ]),
+            (5, 6, [ "if ord2 >= 1 then\n" ]),
+            (0, 1, [ "<!-- #include file = -->\n", "<%\n" ]),
+        ]
+        for lexer_class in [pad.Lexer, pad.RegexLexer]:
+            lexer = lexer_class(incremental = True)
+            lexer.lex(source)
+            parser = pad.Parser(incremental = True)
+            parser.parse(lexer.source_tokens)
+            current = list(source)
+            for start_line, end_line, new_lines in edits:
+                with self.subTest(lexer_class.__name__, edit = (start_line, end_line)):
+                    current[start_line:end_line] = new_lines
+                    first_row, removed, added = lexer.update(start_line, end_line, new_lines)
+                    parser.update(lexer.source_tokens, first_row)
+                    self.assertLess(removed + added, len(current))
+
+                    fresh_lexer = lexer_class()
+                    fresh_lexer.lex(current)
+                    fresh_parser = pad.Parser()
+                    fresh_parser.parse(fresh_lexer.source_tokens)
+                    self.assertEqual(self.dump_tokens(lexer.source_tokens), self.dump_tokens(fresh_lexer.source_tokens))
+                    self.assertEqual(lexer.errors, fresh_lexer.errors)
+                    self.assertEqual(parser.errors, fresh_parser.errors)
+                    self.assertEqual({ name: [ (t.line, t.column) for t in refs ] for name, refs in parser.identified.get("#ref", {}).items() },
+                                     { name: [ (t.line, t.column) for t in refs ] for name, refs in fresh_parser.identified.get("#ref", {}).items() })
+
+    def test_error_recovery(self):
+        source = [
+            "<%\n",
+            "if true then\n",
+            "else\n",
+            "else\n",
+            "end if\n",
+            "end if\n",
+            "for each x in y\n",
+            "end if\n",
+            "dim a(1 + 2)\n",
+            "if a then\n",
+            "    test = 1\n",
+            "end if\n",
+            "%>\n",
+        ]
+        lexer = pad.Lexer()
+        lexer.lex(source)
+        errors = [
+            "Line 4, column 1, token 'else': not valid for close because parent 'else' doesn't allow it",
+            "Line 6, column 1, token 'end if': not valid for close because no parent found",
+            "Line 8, column 1, token 'end if': not valid for close because parent 'for each' doesn't allow it",
+            "Line 9, column 9, token '+': invalid syntax",
+            "Line 7, column 1, token 'for each': close missing",
+        ]
+        for max_errors in [ 1, 3, 10 ]:
+            with self.subTest(max_errors = max_errors):
+                parser = pad.Parser(max_errors = max_errors)
+                parser.parse(lexer.source_tokens)
+                self.assertEqual(parser.errors, errors[:max_errors])
+        self.assertEqual([ i.line for i in parser.identified["for each"] ], [ 7 ])
+        self.assertEqual(list(parser.identified["#ref"]), [ "true", "x", "y", "a", "test" ])
+
+        for source, error in [
+            ([ "<%\n", "if a\n", "else\n", "end if\n", "%>\n" ], "Line 3, column 1, token 'else': not valid for close because parent 'if' is not started"),
+            ([ "<%\n", "if a\n", "if b then\n", "end if\n", "end if\n", "%>\n" ], "Line 3, column 1, token 'if': not valid for create because parent 'if' not started"),
+        ]:
+            with self.subTest(error):
+                lexer = pad.Lexer()
+                lexer.lex(source)
+                parser = pad.Parser(max_errors = 10)
+                parser.parse(lexer.source_tokens)
+                self.assertEqual(parser.errors, [ error ]) # the parent is repaired, no error follows
+
+        lexer = pad.Lexer()
+        lexer.lex([ "<%\n", "if a then\n", "if b then\n", "if c then\n", "next\n", "%>\n" ])
+        parser = pad.Parser(max_errors = 2)
+        parser.parse(lexer.source_tokens)
+        self.assertEqual(parser.errors, [
+            "Line 5, column 1, token 'next': not valid for close because parent 'if' doesn't allow it",
+            "Line 2, column 1, token 'if': close missing",
+        ])
+
+    def test_batch_conversion(self):
+        path = os.path.join(str(Path(__file__).parent), "unittests")
+        files = pad.find_files([ path, os.path.join(path, "if*.ut") ])
+        self.assertEqual(files, [ os.path.join(path, name) for name in [ "if_func.ut", "ifbyval.ut", "ifendif.ut", "ifif.ut" ] ])
+
+        files = pad.find_files([ os.path.join(path, "*.ut") ])
+        results = pad.convert_files(files, jobs = 1)
+        self.assertEqual(pad.convert_files(files, jobs = 2, chunksize = 3), results)
+        for (file, lexer_errors, parser_errors, stats), (name, source, result) in zip(results, self.get_ut_files()):
+            with self.subTest(name):
+                self.assertEqual(file, os.path.join(path, name))
+                self.assertEqual([ err.split(": ", 1)[1] for err in lexer_errors + parser_errors ], result)
+
+        with tempfile.TemporaryDirectory() as root:
+            page = os.path.join(root, "page.asp")
+            header = os.path.join(root, "header.asp")
+            with open(page, 'w') as file:
+                file.write('<!-- #include file="header.asp" -->\n<% if x then\nend if %>\n')
+            with open(header, 'w') as file:
+                file.write('<%\na = 1\nend if\nif z then\n%>\n')
+            self.assertEqual(pad.convert_file(page, root, max_errors = 5)[2], [
+                f"{header}: Line 3, column 1, token 'end if': not valid for close because no parent found",
+                f"{header}: Line 4, column 1, token 'if': close missing",
+            ])
+
+    def test_disk_cache(self):
+        class CountingLexer(pad.Lexer):
+            count = 0
+            def lex(self, source):
+                CountingLexer.count += 1
+                super().lex(source)
+
+        path = os.path.join(str(Path(__file__).parent), "source.asp")
+        with tempfile.TemporaryDirectory() as folder:
+            results = []
+            for run in range(2):
+                pad.include_cache.clear()
+                resolver = pad.IncludeResolver(lexer_class = CountingLexer, disk_cache = pad.DiskCache(folder))
+                rows = list(resolver.iter_rows(path))
+                results.append(self.dump_tokens(rows))
+                self.assertEqual(CountingLexer.count, 2)
+            self.assertEqual(results[0], results[1])
+
+            pad.include_cache.clear()
+            self.assertEqual(pad.convert_file(path, cache_folder = folder), pad.convert_file(path))
+            parser = pad.Parser()
+            data = pad.DiskCache(folder).get("parse", hashlib.sha256(" ".join(resolver.digests + resolver.paths + [ "1" ]).encode()).hexdigest())
+            pad.DiskCache.load_parser(parser, data, rows)
+            self.assertEqual([ (t.line, t.column) for t in parser.identified["#ref"]["val2"] ], [ (23, 1), (28, 20), (30, 5), (51, 16) ])
+            self.assertEqual([ (i.line, i.name) for i in parser.identified["function"] ], [ (33, "some"), (37, "some2"), (41, "some3") ])
+
+            pad.DiskCache(folder, max_size = 0).evict()
+            self.assertEqual([ names for folder, folders, names in os.walk(folder) if len(names) > 0 ], [])
+
+    def test_transpiler(self):
+        class CountingLexer(pad.Lexer):
+            count = 0
+            def lex(self, source):
+                CountingLexer.count += 1
+                super().lex(source)
+
+        with tempfile.TemporaryDirectory() as root:
+            page = os.path.join(root, "page.asp")
+            header = os.path.join(root, "header.asp")
+            with open(page, 'w') as file:
+                file.write('<!-- #include file="header.asp" --><%\n'
+                           'dim items(2), total\n'
+                           'function Add(a, b)\n    Add = a + b\nend function\n'
+                           'for i = 0 to 2\n    items(i) = Add(i, 10)\nnext\n'
+                           'for each item in items\n    total = total + item\n    if item = 11 then\n        exit for\n    end if\nnext\n'
+                           'n = 3\ndo while n > 0\n    n = n - 1\nloop\n'
+                           '%><p><%= title & ": " & total %></p>\n'
+                           '<% Greet "you" %>\n')
+            with open(header, 'w') as file:
+                file.write('<%\nsub Greet(name)\n    Response.Write("Hello " & name & "!")\nend sub\ntitle = "Report"\n%>')
+
+            with tempfile.TemporaryDirectory() as folder:
+                pad.include_cache.clear()
+                pad.page_cache.clear()
+                code, errors = pad.load_page(page, root, CountingLexer, folder)
+                self.assertEqual(errors, [])
+                response = pad.Response()
+                pad.run_page(code, response)
+                self.assertEqual(response.get_value(), "<p>Report: 21</p>\nHello you!\n")
+                self.assertIs(pad.load_page(page, root, CountingLexer, folder)[0], code)
+
+                pad.include_cache.clear()
+                pad.page_cache.clear()
+                self.assertEqual(pad.load_page(page, root, CountingLexer, folder)[0], code)
+                self.assertEqual(CountingLexer.count, 2)
+
+                with open(header, 'w') as file:
+                    file.write('<%\nsub Greet(name)\nend sub\ntitle = 1 / 0\n%>')
+                code, errors = pad.load_page(page, root, CountingLexer, folder)
+                self.assertEqual(CountingLexer.count, 3)
+                try:
+                    pad.run_page(code, pad.Response())
+                    self.fail("ZeroDivisionError not raised")
+                except ZeroDivisionError as error:
+                    traceback = error.__traceback__
+                    while traceback.tb_next:
+                        traceback = traceback.tb_next
+                    self.assertEqual(traceback.tb_frame.f_code.co_filename, page)
+                    self.assertGreater(traceback.tb_lineno, 19) # after the last line of the page
+                    self.assertEqual(error.source_traceback[-1], (header, 4))
+
+        lexer = pad.Lexer()
+        lexer.lex([ "<%\n", "x = (1 + 2\n", "y = 1 2\n", "z = a b : w = 1\n", "%>\n" ])
+        transpiler = pad.Transpiler()
+        self.assertIsNone(transpiler.transpile(lexer.source_tokens, "page.asp"))
+        self.assertEqual(transpiler.errors, [
+            "Line 2, column 5, token '(': ) missing",
+            "Line 3, column 7, token '2': invalid syntax",
+            "Line 4, column 7, token 'b': invalid syntax",
+        ])
+
+        with tempfile.TemporaryDirectory() as root:
+            page = os.path.join(root, "page.asp")
+            header = os.path.join(root, "header.asp")
+            with open(page, 'w') as file:
+                file.write('<!-- #include file="header.asp" -->\n<% c = 1 2 %>\n')
+            with open(header, 'w') as file:
+                file.write('<%\na = 1\nb = (1\n%>\n')
+            self.assertEqual(pad.load_page(page, root), (None, [
+                f"{header}: Line 3, column 5, token '(': ) missing",
+                f"{page}: Line 2, column 10, token '2': invalid syntax",
+            ]))
+
+        lexer = pad.Lexer()
+        lexer.lex([ "<%= y / 2 = 0 %> <%= y \\ 2 %> <%= y mod 3 %> <%= 2 ^ y %> <%= 6 mod (y + 4) %>" ])
+        response = pad.Response()
+        pad.run_page(pad.Transpiler().transpile(lexer.source_tokens, "page.asp"), response)
+        self.assertEqual(response.get_value(), "True 0 0 1 2")
+        self.assertEqual(pad.empty / 2, 0)
+        self.assertRaises(ZeroDivisionError, lambda: 1 / pad.empty)
+
+    def test_coalesce_writes(self):
+        lexer = pad.Lexer()
+        lexer.lex([ "<p>a</p>\n",
+                    "<% Response.Write \"b\" %>\n",
+                    "<%= \"c\" %><% Response.Write(x) %>d<% if x then %>e<% Response.Write 1 %><% end if %>\n",
+                    "<% x = 1 %><% y = 2 %><%= x %>\n" ])
+        transpiler = pad.Transpiler()
+        page = transpiler.build(lexer.source_tokens)
+        page.body = transpiler.coalesce(page.body)
+        self.assertEqual(ast.unparse(ast.Module(transpiler.body_to_ast(page.body), [])).splitlines(), [
+            "response.write('<p>a</p>\\nb\\nc')",
+            "response.write(x)",
+            "response.write('d')",
+            "if x:",
+            "    response.write('e1')",
+            "response.write('\\n')",
+            "x = 1",
+            "y = 2",
+            "response.write(x)",
+            "response.write('\\n')",
+        ])
+        self.assertIs(page.body[0].value.value, sys.intern("<p>a</p>\nb\nc"))
+
+        outputs = []
+        for optimize in [ False, True ]:
+            response = pad.Response()
+            pad.run_page(pad.Transpiler(optimize = optimize).transpile(lexer.source_tokens, "page.asp"), response)
+            outputs.append(response.get_value())
+        self.assertEqual(outputs, [ "<p>a</p>\nb\ncd\n1\n" ] * 2)
+
+    def test_fold_constants(self):
+        source = [ "<%\n",
+                   "ord2 = 3+555 - 2\n",
+                   "if true then\n", "    x = \"a\" & 1 & (2 * 3) & y\n", "elseif z then\n", "    x = 2\n", "end if\n",
+                   "if 1 > 2 then\n", "    x = 0\n", "elseif y = \"a\" & \"b\" then\n", "    x = 9\n", "end if\n",
+                   "do while false\n", "loop\n",
+                   "y = 1 / 0 + 2 ^ 10 + 2 ^ 100\n",
+                   "%>\n" ]
+        lexer = pad.Lexer()
+        lexer.lex(source)
+        transpiler = pad.Transpiler()
+        page = transpiler.build(lexer.source_tokens)
+        page.body = transpiler.fold(page.body)
+        self.assertEqual(ast.unparse(ast.Module(transpiler.body_to_ast(page.body), [])).splitlines(), [
+            "ord2 = 556",
+            "x = f'a16{y}'",
+            "if y == 'ab':",
+            "    x = 9",
+            "y = 1 / 0 + 1024 + 2 ** 100",
+            "response.write('\\n')",
+        ])
+        self.assertEqual(transpiler.notes, [
+            "Line 3, column 4: 1 following branch(es) removed, condition always true",
+            "Line 8, column 4: branch removed, condition always false",
+            "Line 13, column 10: loop removed, condition always false",
+        ])
+
+        for step in [ "-1", "-(1 + 1)" ]:
+            with self.subTest(step):
+                lexer = pad.Lexer()
+                lexer.lex([ f"<% for i = 3 to 1 step {step} %><%= i %><% next %>" ])
+                response = pad.Response()
+                pad.run_page(pad.Transpiler().transpile(lexer.source_tokens, "page.asp"), response)
+                self.assertEqual(response.get_value(), "321" if step == "-1" else "31")
+
+    def test_scopes(self):
+        lexer = pad.Lexer()
+        lexer.lex([ "<%\n", "dim total\n", "count = 0\n",
+                    "function Add(ByVal a, b)\n", "    dim tmp\n", "    tmp = a + b\n", "    total = total + tmp\n", "    b = 0\n",
+                    "    Add = tmp\n", "    note = \"x\"\n", "end function\n",
+                    "sub Show()\n", "    Response.Write(label & total)\n", "end sub\n",
+                    "x = Add(1, 2)\n", "Show\n", "%>" ])
+        transpiler = pad.Transpiler()
+        page = transpiler.build(lexer.source_tokens)
+        module = transpiler.to_module(page)
+        self.assertEqual(page.scope, { "total": "global", "count": "local", "x": "local" })
+        self.assertEqual([ statement.scope for statement in page.body[2:4] ], [
+            { "a": "byval", "b": "byref", "add": "result", "tmp": "dim", "total": "global", "note": "local" },
+            { "label": "global", "total": "global" },
+        ])
+        self.assertEqual(transpiler.notes, [ "Line 4, column 1, token 'function': byref argument 'b' is assigned, it is passed by value" ])
+
+        code = compile(module, "page.asp", "exec")
+        page_code = next(const for const in code.co_consts if hasattr(const, "co_name") and const.co_name == "_page")
+        self.assertEqual(page_code.co_varnames, ("count", "x"))
+        response = pad.Response()
+        pad.run_page(code, response)
+        self.assertEqual(response.get_value(), "3")
+
+        lexer = pad.Lexer()
+        lexer.lex([ "<%\n", "Function Fact(n)\n", "    if n <= 1 then\n", "        Fact = 1\n", "        exit function\n", "    end if\n",
+                    "    Fact = n * Fact(n - 1)\n", "End Function\n", "%><%= Fact(5) %>" ])
+        code = pad.Transpiler().transpile(lexer.source_tokens, "page.asp")
+        response = pad.Response()
+        pad.run_page(code, response)
+        self.assertEqual(response.get_value(), "120")
+
+        lexer = pad.Lexer()
+        lexer.lex([ "<%\n", "x = Seven\n", "Function Seven\n", "    Seven = 7\n", "End Function\n", "%><%= x %> <%= Seven + 1 %>" ])
+        code = pad.Transpiler().transpile(lexer.source_tokens, "page.asp")
+        response = pad.Response()
+        pad.run_page(code, response)
+        self.assertEqual(response.get_value(), "7 8")
+
+    def test_response(self):
+        lexer = pad.Lexer()
+        lexer.lex([ "<% for i = 1 to 5 %>row <%= i %>\n<% next\n",
+                    "if Response.Buffer then\n    Response.Flush\nend if\n",
+                    "Response.Buffer = false\n",
+                    "Response.Write \"é\"\n",
+                    "Response.End\n",
+                    "Response.Write \"not sent\" %>\n" ])
+        code = pad.Transpiler().transpile(lexer.source_tokens, "page.asp")
+
+        chunks = []
+        response = pad.Response(chunks.append, flush_size = 16)
+        pad.run_page(code, response)
+        self.assertEqual(chunks, [ b"row 1\nrow 2\nrow ", b"3\nrow 4\nrow 5\n", "é".encode() ])
+
+        response = pad.Response()
+        pad.run_page(code, response)
+        self.assertEqual(response.get_value(), "row 1\nrow 2\nrow 3\nrow 4\nrow 5\né")
+        response.clear()
+        self.assertEqual(response.get_value(), "")
+
+        with tempfile.TemporaryDirectory() as root:
+            with open(os.path.join(root, "page.asp"), 'w') as file:
+                file.write("<% Response.Status = \"201 Created\" : n = 1 %>a<% Response.Write(n + 1) %>")
+            application = pad.page_application(root, flush_size = 1)
+            calls = []
+            def start_response(status, headers):
+                calls.append((status, headers))
+                return chunks.append
+            chunks = []
+            self.assertEqual(application({ "PATH_INFO": "/page.asp" }, start_response), [])
+            self.assertEqual((calls, chunks), ([ ("201 Created", [ ("Content-Type", "text/html; charset=utf-8") ]) ], [ b"a", b"2" ]))
+            self.assertEqual(application({ "PATH_INFO": "/../page.asp" }, start_response), [ b"Not found" ])
+
+    def test_watcher(self):
+        with tempfile.TemporaryDirectory() as root:
+            os.mkdir(os.path.join(root, "inc"))
+            files = {
+                "a.asp": '<!-- #include file="inc/header.inc" -->a\n',
+                "b.asp": '<!-- #include file="inc/menu.inc" -->b\n',
+                "c.asp": '<% x = 1 %>c\n',
+                os.path.join("inc", "menu.inc"): '<!-- #include file="header.inc" -->menu\n',
+                os.path.join("inc", "header.inc"): '<% title = "x" %>\n',
+            }
+            paths = { name: os.path.join(root, name) for name in files }
+            for name, content in files.items():
+                with open(paths[name], 'w') as file:
+                    file.write(content)
+
+            cache_folder = os.path.join(root, "cache")
+            watcher = pad.Watcher([ root ], root, cache_folder = cache_folder)
+            self.assertEqual(watcher.rebuild(watcher.poll()), { paths[name]: [] for name in [ "a.asp", "b.asp", "c.asp" ] })
+            self.assertEqual(watcher.poll(), set())
+            self.assertEqual(watcher.included_by[paths[os.path.join("inc", "header.inc")]], { paths["a.asp"], paths[os.path.join("inc", "menu.inc")] })
+
+            with open(paths[os.path.join("inc", "header.inc")], 'w') as file:
+                file.write('<% title = "header" %>\n')
+            changed = watcher.poll()
+            self.assertEqual(changed, { paths[os.path.join("inc", "header.inc")] })
+            self.assertEqual(list(watcher.rebuild(changed)), [ paths["a.asp"], paths["b.asp"] ])
+            response = pad.Response()
+            pad.run_page(pad.page_cache[paths["b.asp"]][0], response)
+            self.assertEqual(response.get_value(), "\nmenu\nb\n")
+
+            class FailingLexer(pad.Lexer):
+                def lex(self, source):
+                    raise AssertionError("lexed again")
+            code = pad.page_cache.pop(paths["b.asp"])[0]
+            pad.include_cache.clear()
+            self.assertEqual(pad.load_page(paths["b.asp"], root, FailingLexer, cache_folder)[0], code) # built by the watcher, on disk
+
+            os.remove(paths[os.path.join("inc", "menu.inc")])
+            results = watcher.rebuild(watcher.poll())
+            self.assertEqual(list(results), [ paths["b.asp"] ])
+            self.assertTrue(results[paths["b.asp"]][0].endswith("Include file not found: inc/menu.inc"))
+            self.assertNotIn(paths["b.asp"], pad.page_cache)
+            with open(paths[os.path.join("inc", "menu.inc")], 'w') as file:
+                file.write('menu 2\n')
+            self.assertEqual(watcher.rebuild(watcher.poll()), { paths["b.asp"]: [] })
+
+    def test_symbol_index(self):
+        with tempfile.TemporaryDirectory() as root:
+            page = os.path.join(root, "page.asp")
+            header = os.path.join(root, "header.asp")
+            with open(page, 'w') as file:
+                file.write("<%\nfunction Total(a, b)\nend function\nx = total(1, 2)\n%>\n")
+            with open(header, 'w') as file:
+                file.write("<% dim x, count\ncount = Total(x, 1) %>\n")
+
+            index = pad.SymbolIndex()
+            index.index_file(page)
+            index.index_file(header)
+            self.assertEqual(index.find_definitions("TOTAL"), [ (page, "function", 2, 10) ])
+            self.assertEqual(index.find_definitions("x"), [ (header, "dim", 1, 8) ])
+            self.assertEqual(index.find_references("total"), [ (header, 2, 9), (page, 4, 5) ])
+            self.assertEqual(index.find_at(page, 2, 14), ("total", "function"))
+            self.assertEqual(index.find_at(page, 4, 1), ("x", None))
+            self.assertIsNone(index.find_at(page, 4, 2))
+
+            with open(page, 'w') as file:
+                file.write("<%\ny = 1\n%>\n")
+            index.index_file(page)
+            self.assertEqual(index.find_definitions("total"), [])
+            self.assertEqual(index.find_references("total"), [ (header, 2, 9) ])
+
+            index.save(os.path.join(root, "index"))
+            loaded = pad.SymbolIndex()
+            loaded.load(os.path.join(root, "index"))
+            self.assertEqual(loaded.definitions, index.definitions)
+            self.assertEqual(loaded.references, index.references)
+            self.assertEqual(loaded.find_at(header, 2, 1), ("count", None))
+
+            with open(page, 'w') as file:
+                file.write("<%\nPublic Function Total(a, b)\n    Total = a + b\nEnd Function\nPrivate Sub Show(x)\n    Response.Write x\nEnd Sub\nShow Total(1, 2)\n%>\n")
+            index.index_file(page)
+            self.assertEqual(index.find_definitions("total"), [ (page, "function", 2, 17) ])
+            self.assertEqual(index.find_definitions("show"), [ (page, "sub", 5, 13) ])
+            code, errors = pad.load_page(page, root)
+            self.assertEqual(errors, [])
+            response = pad.Response()
+            pad.run_page(code, response)
+            self.assertEqual(response.get_value(), "3\n")
+
+    def test_daemon(self):
+        with tempfile.TemporaryDirectory() as root:
+            page = os.path.join(root, "page.asp")
+            with open(page, 'w') as file:
+                file.write('<!-- #include file="header.inc" -->\n<%\nfunction Total(a, b)\nend function\nx = total(1, 2)\n%>\n')
+            with open(os.path.join(root, "header.inc"), 'w') as file:
+                file.write('<% if x then %>\n')
+
+            daemon = pad.Daemon(root, jobs = 1)
+            def request(method, params, id = 1):
+                line = json.dumps({ "jsonrpc": "2.0", "id": id, "method": method, "params": params })
+                return asyncio.run(daemon.handle(line))
+
+            result = request("parse", { "path": page })["result"]
+            self.assertEqual(result["errors"], [])
+            self.assertEqual(result["definitions"], [ { "name": "total", "type": "function", "line": 3, "column": 10 } ])
+            self.assertEqual(request("definitions", [ "TOTAL" ])["result"], [ { "path": page, "type": "function", "line": 3, "column": 10 } ])
+            self.assertEqual(request("symbol_at", { "path": page, "line": 5, "column": 1 })["result"], { "name": "x", "type": None })
+            self.assertEqual(request("diagnostics", { "path": page })["result"]["errors"], 
+                [ f"{page}: Line 3, column 1, token 'function': not valid for create because parent 'if' doesn't allow it" ])
+            self.assertEqual(request("diagnostics", { "path": page, "text": "<% next %>" })["result"]["errors"],
+                [ f"{page}: Line 1, column 4, token 'next': not valid for close because no parent found" ])
+            self.assertEqual(request("lex", { "path": page, "text": "<% x = 1 %>" })["result"]["tokens"][0][0], [ "I", "x", None, 1, 4 ])
+            self.assertEqual(list(daemon.results), [ ("parse", page) ])
+
+            self.assertEqual(request("unknown", {})["error"]["code"], -32601)
+            self.assertEqual(request("lex", { "file": page })["error"]["code"], -32602)
+            self.assertEqual(request("lex", { "path": os.path.join(root, "missing.asp") })["error"]["code"], -32000)
+            self.assertEqual(request("symbol_at", { "path": page, "line": "5", "column": 1 })["error"],
+                { "code": -32602, "message": "Invalid params: wrong type for 'line'" })
+            self.assertEqual(request("lex", { "path": page, "text": 5 })["error"]["code"], -32602)
+            self.assertEqual(request("index", { "paths": root })["error"]["code"], -32602)
+            async def broken(path):
+                raise KeyError(path)
+            daemon.methods["broken"] = broken
+            self.assertEqual(request("broken", [ "x" ])["error"], { "code": -32603, "message": "Internal error: KeyError: 'x'" })
+            self.assertEqual(asyncio.run(daemon.handle("{")), { "jsonrpc": "2.0", "id": None, "error": { "code": -32700, "message": "Parse error" } })
+            self.assertIsNone(asyncio.run(daemon.handle(json.dumps({ "jsonrpc": "2.0", "method": "lex", "params": { "path": page } }))))
+
+    @unittest.skipUnless(hasattr(socket, "AF_UNIX"), "no Unix sockets")
+    def test_daemon_socket(self):
+        with tempfile.TemporaryDirectory() as root:
+            page = os.path.join(root, "page.asp")
+            with open(page, 'w') as file:
+                file.write('<% x = 1 %>\n')
+            socket_path = os.path.join(root, "pad.sock")
+            daemon = pad.Daemon(root, jobs = 1)
+
+            async def client():
+                serving = asyncio.ensure_future(daemon.serve(socket_path))
+                while not os.path.exists(socket_path):
+                    await asyncio.sleep(0.01)
+                reader, writer = await asyncio.open_unix_connection(socket_path)
+                responses = []
+                for id, method in enumerate([ "parse", "references" ]):
+                    params = { "path": page } if method == "parse" else { "name": "x" }
+                    writer.write(json.dumps({ "jsonrpc": "2.0", "id": id, "method": method, "params": params }).encode() + b"\n")
+                    await writer.drain()
+                    responses.append(json.loads(await reader.readline()))
+                writer.write(b'{"jsonrpc": "2.0", "id": 2, "method": "shutdown"}\n')
+                responses.append(json.loads(await reader.readline()))
+                await serving
+                writer.close()
+                return responses
+
+            responses = asyncio.run(client())
+            self.assertEqual(responses, [ { "jsonrpc": "2.0", "id": 0, "result": { "errors": [], "definitions": [],
+                                                                                "references": [ { "name": "x", "line": 1, "column": 4 } ] } },
+                                          { "jsonrpc": "2.0", "id": 1, "result": [ { "path": page, "line": 1, "column": 4 } ] },
+                                          { "jsonrpc": "2.0", "id": 2, "result": None } ])
+            self.assertFalse(os.path.exists(socket_path))
+
+    def test_benchmark_pages(self):
+        for name, parameters in pad_benchmark.scenarios.items():
+            with self.subTest(name):
+                parameters = dict(parameters, lines = min(parameters["lines"], 1000))
+                result = pad_benchmark.run_scenario(parameters, repeat = 1)
+                self.assertGreaterEqual(result["lines"], parameters["lines"])
+                self.assertGreater(result["tokens"], 0)
+
+    def test_stats(self):
+        events = []
+        pad.Stats.hooks.append(lambda stats, phase, seconds, allocations: events.append((stats.name, phase)))
+        try:
+            path = os.path.join(str(Path(__file__).parent), "source.asp")
+            pad.include_cache.clear()
+            file, lexer_errors, parser_errors, stats = pad.convert_file(path, stats = True)
+        finally:
+            pad.Stats.hooks.pop()
+        self.assertEqual(set(stats.phases), { "file", "load", "scan", "keywords", "parse", "rules" })
+        self.assertEqual(stats.phases["load"][0], 2)
+        self.assertEqual(stats.phases["parse"][0], 1)
+        self.assertEqual(stats.phases["keywords"][0], 2) # once per file lexed
+        self.assertEqual(stats.phases["rules"][0], 1)
+        self.assertEqual(events.count((path, "keywords")), 2)
+        self.assertEqual(stats.token_types[pad.Token.PRINTINCFILE], 2)
+        self.assertEqual(stats.branch_paths["if > if"], 1)
+        self.assertIn((path, "rules"), events)
+        self.assertEqual(events[-1], (path, "file"))
+
+        total = pad.Stats()
+        total.merge(stats)
+        total.merge(stats)
+        self.assertEqual(total.phases["parse"][0], 2)
+        self.assertEqual(total.files, [ (stats.phases["file"][1], path) ] * 2)
+
+    def get_ut_files(self):
         path = os.path.join(str(Path(__file__).parent), "unittests")
-        for file in os.listdir(path):
+        for file in sorted(os.listdir(path)):
             if file.endswith(".ut"):
                 with open(os.path.join(path, file), 'r') as file_content:
                     content = file_content.readlines()
                     asp_end_index = content.index("%>\n") + 1
-                    source = content[:asp_end_index]
-                    result = content[asp_end_index:]
-                    with self.subTest(file):
-                        lexer = pad.Lexer()
-                        lexer.lex(source)
-                        if len(lexer.errors) > 0:
-                            self.assertEqual(lexer.errors, result)
-                        else:
-                            parser = pad.Parser()
-                            parser.parse(lexer.source_tokens)
-                            self.assertEqual(parser.errors, result)
+                    yield file, content[:asp_end_index], [ line.rstrip("\n") for line in content[asp_end_index:] ]
+
+    def dump_tokens(self, rows):
+        return [ [ (t.type, t.name, t.value, t.line, t.column) for t in row ] for row in rows ]
 
     #def test_sample(self):
     #    self.assertTrue('FOO'.isupper())